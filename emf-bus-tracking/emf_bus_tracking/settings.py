@@ -120,6 +120,16 @@ CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
 CELERY_TASK_SERIALIZER = "json"
 CELERY_ACCEPT_CONTENT = ["json"]
 
+# When set, estimator work is split across queues estimator-0 .. estimator-(N-1) instead of going to the default
+# queue; each of those then needs a worker of its own: celery -A emf_bus_tracking worker -Q estimator-N -c 1
+TRACKING_ESTIMATOR_PARTITIONS = int(os.getenv("TRACKING_ESTIMATOR_PARTITIONS", "0"))
+# Estimated times that move by less than this aren't saved
+TRACKING_ESTIMATE_WRITE_THRESHOLD_SECONDS = int(os.getenv("TRACKING_ESTIMATE_WRITE_THRESHOLD_SECONDS", "5"))
+# Hand vehicle reports to the long running estimator-service command instead of Celery
+TRACKING_ESTIMATOR_SERVICE = bool(os.getenv("TRACKING_ESTIMATOR_SERVICE", False))
+# Reports from parked vehicles are skipped unless one of their journeys starts within this many minutes
+TRACKING_IDLE_JOURNEY_WINDOW_MINUTES = int(os.getenv("TRACKING_IDLE_JOURNEY_WINDOW_MINUTES", "15"))
+
 CELERY_BEAT_SCHEDULE = {
     "gtfs-rt": {
         "task": "gtfs.gtfs_rt_tasks.generate_gtfs_rt",
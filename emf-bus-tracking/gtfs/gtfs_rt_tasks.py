@@ -1,4 +1,3 @@
-import datetime
 import json
 import google.protobuf.json_format
 from django.db.models import Q
@@ -183,19 +182,15 @@ def add_trip_updates(msg: gtfs_realtime_pb2.FeedMessage, msg_json: dict):
             )
 
             if point.real_time_arrival:
-                timestamp = datetime.datetime.combine(journey.date, point.real_time_arrival)
-                stop_time_update.arrival.time = int(timestamp.timestamp())
+                stop_time_update.arrival.time = int(point.real_time_arrival.timestamp())
                 stop_time_update.arrival.uncertainty = 0
             elif point.estimated_arrival:
-                timestamp = datetime.datetime.combine(journey.date, point.estimated_arrival)
-                stop_time_update.arrival.time = int(timestamp.timestamp())
+                stop_time_update.arrival.time = int(point.estimated_arrival.timestamp())
             if point.real_time_departure:
-                timestamp = datetime.datetime.combine(journey.date, point.real_time_departure)
-                stop_time_update.departure.time = int(timestamp.timestamp())
+                stop_time_update.departure.time = int(point.real_time_departure.timestamp())
                 stop_time_update.departure.uncertainty = 0
             elif point.estimated_departure:
-                timestamp = datetime.datetime.combine(journey.date, point.estimated_departure)
-                stop_time_update.departure.time = int(timestamp.timestamp())
+                stop_time_update.departure.time = int(point.estimated_departure.timestamp())
 
             if not point.real_time_arrival and not point.real_time_departure \
                     and not point.estimated_arrival and not point.estimated_departure:
@@ -67,7 +67,7 @@ def handle_t24_gps(tracker: models.Tracker, t24_message: track24_gps.Track24Mess
         ).save()
 
         if last_position is None or timestamp > last_position.timestamp:
-            tracking.estimator.vehicle_report.delay(str(tracker.vehicle.id))
+            tracking.estimator.schedule_vehicle_report(str(tracker.vehicle.id))
 
 
 def handle_nal_gps(tracker: models.Tracker, nal_report: nal_gps.NALReport, message: dict):
@@ -99,4 +99,4 @@ def handle_nal_gps(tracker: models.Tracker, nal_report: nal_gps.NALReport, messa
         ).save()
 
         if last_position is None or timestamp > last_position.timestamp:
-            tracking.estimator.vehicle_report.delay(str(tracker.vehicle.id))
+            tracking.estimator.schedule_vehicle_report(str(tracker.vehicle.id))
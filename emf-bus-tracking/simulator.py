@@ -7,10 +7,11 @@ IMEI = "300234011532400"
 
 
 def main():
+    import kosmos.models
     import tracking.models
     import tracking.estimator
 
-    tracker = tracking.models.Tracker.objects.get(imei=IMEI)
+    tracker = kosmos.models.Tracker.objects.get(imei=IMEI)
 
     with open("sim/sim_data.json", "r") as f:
         data = json.load(f)
@@ -43,7 +44,7 @@ def main():
                     longitude=data_point["long"],
                     velocity_ms=data_point["velocity"],
                 ).save()
-                tracking.estimator.vehicle_report.delay(str(vehicle.id))
+                tracking.estimator.schedule_vehicle_report(str(tracker.vehicle.id))
 
         now += datetime.timedelta(seconds=5)
         time.sleep(0.3)
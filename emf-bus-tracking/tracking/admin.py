@@ -407,6 +407,12 @@ class ShapeAdmin(SortableAdminBase, admin.ModelAdmin):
         return TemplateResponse(request, "tracking/shape_update_average_speed_data.html", context)
 
 
+@admin.register(models.Geofence)
+class GeofenceAdmin(admin.ModelAdmin):
+    list_display = ("name", "kind", "radius_meters")
+    readonly_fields = ("id",)
+
+
 class ServiceAlertPeriodAdmin(admin.TabularInline):
     model = models.ServiceAlertPeriod
 
@@ -1,5 +1,7 @@
 import enum
 
+KMH_TO_MS = 0.27777777777778
+
 
 class Days(enum.Enum):
     MONDAY = 0
@@ -0,0 +1,114 @@
+import dataclasses
+import datetime
+import typing
+import uuid
+from django.db.models import Min, Max
+from . import models, path_cache
+
+DAY_PLAN_CACHE_SIZE = 64
+
+
+@dataclasses.dataclass
+class PlannedJourney:
+    journey_id: uuid.UUID
+    point_ids: typing.List[uuid.UUID]
+    stop_ids: typing.List[uuid.UUID]
+    forms_into_id: typing.Optional[uuid.UUID]
+    start_time: typing.Optional[datetime.datetime] = None
+    end_time: typing.Optional[datetime.datetime] = None
+
+
+class DayPlan:
+    """The journeys a vehicle is scheduled to run on a service day, in order, with their stops. Journeys from other
+    days (a block running past midnight) aren't in the plan, so lookups for those fall back to the database."""
+
+    def __init__(self, journeys: typing.List[PlannedJourney]):
+        self.journeys = {journey.journey_id: journey for journey in journeys}
+        self.journey_ids = [journey.journey_id for journey in journeys]
+
+    def __contains__(self, journey_id):
+        return journey_id in self.journeys
+
+    def last_point_id(self, journey: models.Journey) -> typing.Optional[uuid.UUID]:
+        if journey.id in self.journeys:
+            point_ids = self.journeys[journey.id].point_ids
+            return point_ids[-1] if point_ids else None
+
+        last_point = journey.points.order_by('order').last()
+        return last_point.id if last_point else None
+
+    def in_service(self, now: datetime.datetime, before: datetime.timedelta, after: datetime.timedelta) -> bool:
+        """Whether any journey is scheduled to be running at this time, or to start within before of it, allowing
+        journeys to run up to after late"""
+
+        return any(
+            journey.start_time - before <= now <= (journey.end_time or journey.start_time) + after
+            for journey in self.journeys.values() if journey.start_time
+        )
+
+    def following_journey_ids(self, journey: models.Journey) -> typing.List[uuid.UUID]:
+        """The journeys the vehicle runs after this one for the rest of the day, in order"""
+
+        following = []
+        planned = self.journeys.get(journey.id)
+        while planned and planned.forms_into_id and planned.forms_into_id not in following:
+            following.append(planned.forms_into_id)
+            planned = self.journeys.get(planned.forms_into_id)
+        return following
+
+    def next_journey(self, journey: models.Journey) -> typing.Optional[models.Journey]:
+        if journey.id not in self.journeys:
+            return journey.forms_into_opt()
+
+        forms_into_id = self.journeys[journey.id].forms_into_id
+        if not forms_into_id:
+            return None
+
+        return models.Journey.objects.select_related("shape").get(id=forms_into_id)
+
+
+def build_plan(vehicle_id, service_date: datetime.date) -> DayPlan:
+    journey_times = list(models.Journey.objects.filter(
+        vehicle_id=vehicle_id
+    ).annotate(
+        start_time=Min("points__departure_time"),
+        last_arrival_time=Max("points__arrival_time"),
+        last_departure_time=Max("points__departure_time"),
+    ).filter(
+        start_time__date=service_date
+    ).order_by("start_time").values_list("id", "start_time", "last_arrival_time", "last_departure_time"))
+    journey_ids = [journey_id for journey_id, *_ in journey_times]
+
+    forms_into = dict(models.Journey.objects.filter(
+        forms_from_id__in=journey_ids
+    ).values_list("forms_from_id", "id"))
+
+    journeys = {journey_id: PlannedJourney(
+        journey_id=journey_id, point_ids=[], stop_ids=[], forms_into_id=forms_into.get(journey_id),
+        start_time=start_time, end_time=max(filter(None, (last_arrival_time, last_departure_time)), default=None)
+    ) for journey_id, start_time, last_arrival_time, last_departure_time in journey_times}
+    for journey_id, point_id, stop_id in models.JourneyPoint.objects.filter(
+        journey_id__in=journey_ids
+    ).order_by("journey_id", "order").values_list("journey_id", "id", "stop_id"):
+        journeys[journey_id].point_ids.append(point_id)
+        journeys[journey_id].stop_ids.append(stop_id)
+
+    return DayPlan(list(journeys.values()))
+
+
+local_plans = path_cache.LRUCache(DAY_PLAN_CACHE_SIZE)
+
+
+def get_plan(vehicle_id, service_date: datetime.date) -> DayPlan:
+    """Returns the day plan for a vehicle from this process's cache, building it if the schedule has changed since"""
+
+    if vehicle_id is None:
+        return DayPlan([])
+
+    key = (str(vehicle_id), service_date, path_cache.day_plans_generation())
+    if plan := local_plans.get(key):
+        return plan
+
+    plan = build_plan(vehicle_id, service_date)
+    local_plans.put(key, plan)
+    return plan
@@ -1,81 +1,105 @@
+import contextlib
 import dataclasses
 import enum
+import io
 import typing
+import uuid
 import datetime
+import numpy
+import numpy.typing
 import scipy.spatial
 import shapely
-import geographiclib.geodesic
 import logging
-import contextlib
 import time
+import zlib
+import collections
 import django.core.cache
 import emf_bus_tracking.celery
 from celery import shared_task
+from django.conf import settings
 from django.utils import timezone
-from django.db import transaction
+from django.db import transaction, connection
 
-from . import models, consts
+from . import models, consts, path_cache, geodesy, live_state, kalman, telemetry, stop_index, day_plan, geofences
 
-WGS84_GEOD = geographiclib.geodesic.Geodesic(6378.137, 1 / 298.257223563)  # major, flattening
 REALTIME_CUTOFF = datetime.timedelta(minutes=15)
 STOP_SEARCH_RADIUS_METERS = 75
 MINIMUM_STOP_TIME = datetime.timedelta(seconds=60)
-GPS_VARIANCE = 2.5
-
-LOCK_EXPIRE = 60 * 5  # 5 minutes
+MINIMUM_LAYOVER = datetime.timedelta(minutes=2)
+STATIONARY_SPEED_MS = 0.5
+IDLE_REASONS = ("geofence", "stationary")
+
+ESTIMATE_SWEEP_INTERVAL = 15
+ESTIMATE_SWEEP_CHUNK_SIZE = 10
+ESTIMATE_SWEEP_TICK_KEY = "tracking_estimate_sweep_tick"
+# Long enough to cover a queued and running report; if a worker dies reports for its vehicle resume after this
+REPORT_PENDING_TIMEOUT = 60
+LOCK_EXPIRE = 60 * 5
+LOCK_RETRY_DELAY = 1
+REPORTS_COALESCED_KEY = "tracking_vehicle_reports_coalesced"
+REPORTS_IDLE_KEY = "tracking_vehicle_reports_idle"
+ESTIMATE_FIELDS = ("estimated_arrival", "estimated_departure")
+ESTIMATE_WRITES_SUPPRESSED_KEY = "tracking_estimate_writes_suppressed"
+ESTIMATOR_SERVICE_CHANNEL = "tracking_vehicle_report"
+
+# Set by the estimator service, which collects estimate writes here and flushes them in batches
+estimate_buffer: typing.Optional[typing.Dict[uuid.UUID, models.JourneyPoint]] = None
 
 
 @emf_bus_tracking.celery.app.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
-    sender.add_periodic_task(15.0, update_journey_estimates.s())
+    sender.add_periodic_task(float(ESTIMATE_SWEEP_INTERVAL), update_journey_estimates.s())
+    sender.add_periodic_task(float(live_state.LIVE_STATE_FLUSH_INTERVAL), flush_live_states.s())
+
+
+def estimator_partitions() -> int:
+    return getattr(settings, "TRACKING_ESTIMATOR_PARTITIONS", 0)
+
+
+def estimator_queue(vehicle_id) -> typing.Optional[str]:
+    """The queue for a vehicle's estimator work; the default queue unless partitioning is turned on. When it is all
+    of a vehicle's work goes to one of estimator-0 .. estimator-N-1, and each of those must be consumed by a single
+    worker process (celery worker -Q estimator-N -c 1) so a vehicle's reports and estimates run in order."""
+
+    if not estimator_partitions():
+        return None
+
+    return f"estimator-{zlib.crc32(str(vehicle_id).encode()) % estimator_partitions()}"
 
 
 @contextlib.contextmanager
-def memcache_lock(lock_id, oid):
+def vehicle_lock(vehicle_id):
+    """Stops a vehicle's reports and estimates running at the same time on different workers of the default queue,
+    yielding whether the lock was taken. It's never waited for; work that can't take it is retried or skipped.
+    Partitioned queues already run a vehicle's work one at a time, so no lock is taken for those."""
+
+    if estimator_partitions():
+        yield True
+        return
+
+    key = f"tracking_estimator_lock:{vehicle_id}"
     timeout_at = time.monotonic() + LOCK_EXPIRE - 3
-    status = django.core.cache.cache.add(lock_id, oid, LOCK_EXPIRE)
+    acquired = django.core.cache.cache.add(key, True, LOCK_EXPIRE)
+
     try:
-        yield status
+        yield acquired
     finally:
-        if time.monotonic() < timeout_at and status:
-            django.core.cache.cache.delete(lock_id)
+        if acquired and time.monotonic() < timeout_at:
+            django.core.cache.cache.delete(key)
 
 
-@dataclasses.dataclass
-class SpeedAtTime:
-    from_time: datetime.time
-    to_time: datetime.time
-    speed_ms: float
+SPEED_BIN_SECONDS = 60 * 60
+SPEED_BINS_PER_DAY = 24 * 60 * 60 // SPEED_BIN_SECONDS
+SPEED_BINS_PER_WEEK = SPEED_BINS_PER_DAY * 7
+DEFAULT_SPEED_KMH = 30
 
 
-@dataclasses.dataclass
-class Speed:
-    monday: typing.List[SpeedAtTime]
-    tuesday: typing.List[SpeedAtTime]
-    wednesday: typing.List[SpeedAtTime]
-    thursday: typing.List[SpeedAtTime]
-    friday: typing.List[SpeedAtTime]
-    saturday: typing.List[SpeedAtTime]
-    sunday: typing.List[SpeedAtTime]
-    limit_ms: float
-
-    def average_speed_at_time(self, time: datetime.datetime):
-        day = time.weekday()
-        speed_map = {
-            0: self.monday,
-            1: self.tuesday,
-            2: self.wednesday,
-            3: self.thursday,
-            4: self.friday,
-            5: self.saturday,
-            6: self.sunday
-        }
-
-        for speed in speed_map[day]:
-            if speed.from_time <= time.time() <= speed.to_time:
-                return speed.speed_ms
-
-        return self.limit_ms
+def speed_bin(time: datetime.datetime) -> typing.Tuple[int, float]:
+    """Index into the week of speed bins for a time, and the number of seconds into that bin"""
+
+    seconds_into_day = time.hour * 3600 + time.minute * 60 + time.second + time.microsecond / 1000000
+    day_bin, seconds_into_bin = divmod(seconds_into_day, SPEED_BIN_SECONDS)
+    return time.weekday() * SPEED_BINS_PER_DAY + int(day_bin), seconds_into_bin
 
 
 class Point:
@@ -87,12 +111,6 @@ class Point:
     def __str__(self):
         return str(self.point)
 
-    def distance_to(self, other: "Point") -> float:
-        return WGS84_GEOD.Inverse(
-            self.lat, self.long, other.lat, other.long,
-            geographiclib.geodesic.Geodesic.DISTANCE
-        )["s12"] * 1000  # km to m
-
     @property
     def lat(self) -> float:
         return self.point.y
@@ -110,74 +128,317 @@ class Point:
         return self.point.y
 
 
+@dataclasses.dataclass
+class Projection:
+    segment_index: int
+    fraction: float
+    distance_along: float
+    cross_track_error: float
+
+
+@dataclasses.dataclass
+class StopPosition:
+    segment_index: int
+    fraction: float
+    distance_along: float
+
+
 class Path:
-    stops: typing.List[Point]
-    distances: typing.List[float]
-    speeds: typing.List[Speed]
+    shape_id: typing.Optional[uuid.UUID]
+    reverse: bool
+    # The shape's generation when the path was built, which persisted stop projections must match
+    generation: typing.Optional[str]
+    # Projections of stops onto the path, keyed on stop ID and coordinates
+    stop_positions: typing.Dict[typing.Tuple[uuid.UUID, float, float], StopPosition]
+    latitudes: numpy.ndarray
+    longitudes: numpy.ndarray
+    distances: numpy.ndarray
+    cumulative_distances: numpy.ndarray
+    # Average speed in m/s of each segment, indexed by [segment, day, bin of the day]
+    speed_table: numpy.ndarray
+    # Seconds to travel between consecutive stops by bin of the week, keyed on the stops' distances along the path
+    travel_time_tables: typing.Dict[typing.Tuple[float, ...], numpy.ndarray]
+    # Points in metres east and north of the middle of the path, for nearest neighbour and projection
+    projection: geodesy.LocalProjection
+    coords: numpy.ndarray
     kd_tree: scipy.spatial.KDTree
 
-    def __init__(self, points: typing.List[Point], speeds: typing.List[Speed]):
+    def __init__(self, points: typing.List[Point], speed_table: numpy.ndarray):
+        self.shape_id = None
+        self.reverse = False
+        self.generation = None
+        self.stop_positions = {}
         self.points = points
-        self.distances = []
-        self.speeds = speeds
-        self.kd_tree = scipy.spatial.KDTree([(p.x, p.y) for p in points])
+        self.latitudes = numpy.array([p.lat for p in points], dtype=numpy.float64)
+        self.longitudes = numpy.array([p.long for p in points], dtype=numpy.float64)
+        self.speed_table = speed_table
+        self.travel_time_tables = {}
+        self.projection = geodesy.LocalProjection(
+            float(numpy.mean(self.latitudes)) if len(points) else 0.0,
+            float(numpy.mean(self.longitudes)) if len(points) else 0.0
+        )
+        self.coords = self.to_coords(self.latitudes, self.longitudes)
+        self.segment_starts = self.coords[:-1]
+        self.segment_vectors = self.coords[1:] - self.coords[:-1]
+        self.segment_lengths_sq = numpy.sum(self.segment_vectors ** 2, axis=1)
+        self.segment_mins = numpy.minimum(self.coords[:-1], self.coords[1:])
+        self.segment_maxs = numpy.maximum(self.coords[:-1], self.coords[1:])
+        self.kd_tree = scipy.spatial.KDTree(self.coords)
+        self.set_distances(numpy.zeros(max(len(points) - 1, 0)))
+
+    def to_coords(self, lat: numpy.typing.ArrayLike, long: numpy.typing.ArrayLike) -> numpy.ndarray:
+        return self.projection.to_xy(lat, long)
 
     def calculate_distances(self):
-        for i, point in enumerate(self.points[:-1]):
-            next_point = self.points[i + 1]
+        self.set_distances(geodesy.segment_lengths(self.latitudes, self.longitudes))
 
-            dist = point.distance_to(next_point)
-            self.distances.append(dist)
+    def set_distances(self, distances: numpy.ndarray):
+        self.distances = distances
+        # cumulative_distances[i] is the distance along the path to point i
+        self.cumulative_distances = numpy.concatenate(([0.0], numpy.cumsum(distances)))
 
     def point(self, i: int) -> Point:
         return self.points[i]
 
-    def get_closest_points(self, point: Point, k: int) -> typing.List[typing.Tuple[Point, int]]:
-        _, idx = self.kd_tree.query((point.x, point.y), k=k)
-        return [(self.points[i], i) for i in idx] if k > 1 else [(self.points[idx], idx)]
+    @property
+    def length(self) -> float:
+        return float(self.cumulative_distances[-1])
+
+    def project_onto_segments(
+            self, target: numpy.ndarray, candidates: numpy.ndarray, first_segment: int, first_fraction: float
+    ) -> typing.Tuple[int, float, float]:
+        if len(candidates) == 0:
+            return first_segment, first_fraction, numpy.inf
+
+        starts = self.segment_starts[candidates]
+        vectors = self.segment_vectors[candidates]
+        lengths_sq = self.segment_lengths_sq[candidates]
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            fractions = numpy.where(
+                lengths_sq > 0, numpy.sum((target - starts) * vectors, axis=1) / lengths_sq, 0.0
+            )
+        fractions = numpy.clip(fractions, 0.0, 1.0)
+        fractions[candidates == first_segment] = numpy.maximum(
+            fractions[candidates == first_segment], first_fraction
+        )
+        offsets = starts + fractions[:, numpy.newaxis] * vectors - target
+        distances_sq = numpy.sum(offsets ** 2, axis=1)
+        best = int(numpy.argmin(distances_sq))
+
+        return int(candidates[best]), float(fractions[best]), float(distances_sq[best])
+
+    def project(self, point: Point, min_distance: typing.Optional[float] = None) -> Projection:
+        """Projects a point onto the nearest part of the path. If min_distance is given only the path from that
+        distance onwards is considered, so a vehicle can't be placed behind where it is already known to be."""
+
+        target = self.to_coords(point.lat, point.long)
+
+        if len(self.distances) == 0:
+            return Projection(segment_index=0, fraction=0.0, distance_along=0.0,
+                              cross_track_error=float(numpy.linalg.norm(self.coords[0] - target)))
+
+        first_segment, first_fraction = 0, 0.0
+        if min_distance is not None:
+            first_segment, first_fraction = self.position_at_distance(min_distance)
+
+        # No part of the path is further away than its nearest vertex, so only segments whose bounding boxes come
+        # within that distance of the point can be closest
+        radius, _ = self.kd_tree.query(target)
+        window = numpy.all(
+            (self.segment_mins[first_segment:] <= target + radius) &
+            (self.segment_maxs[first_segment:] >= target - radius),
+            axis=1
+        )
+        candidates = numpy.flatnonzero(window) + first_segment
+        segment_index, fraction, distance_sq = self.project_onto_segments(
+            target, candidates, first_segment, first_fraction
+        )
+        # When only the path ahead is allowed the closest part of it can be outside the window
+        if distance_sq > radius ** 2 and len(candidates) != len(self.distances) - first_segment:
+            segment_index, fraction, distance_sq = self.project_onto_segments(
+                target, numpy.arange(first_segment, len(self.distances)), first_segment, first_fraction
+            )
 
-    def distance_between(self, i: int, j: int) -> float:
-        return sum(self.distances[i:j])
+        return Projection(
+            segment_index=segment_index,
+            fraction=fraction,
+            distance_along=self.distance_along(segment_index, fraction),
+            cross_track_error=float(numpy.sqrt(distance_sq)),
+        )
 
-    def distance_to_end(self, i: int) -> float:
-        return sum(self.distances[i:])
+    def distance_along(self, i: int, fraction: float = 0) -> float:
+        """Distance from the start of the path to a point the given fraction of the way along segment i"""
+
+        if i >= len(self.distances):
+            return self.length
+        return float(self.cumulative_distances[i] + self.distances[i] * fraction)
+
+    def position_at_distance(self, distance: float) -> typing.Tuple[int, float]:
+        """Inverse of distance_along; returns the segment index and fraction along it at a distance from the
+        start of the path"""
+
+        if len(self.distances) == 0:
+            return 0, 0.0
+
+        distance = min(max(distance, 0.0), self.length)
+        i = int(numpy.searchsorted(self.cumulative_distances, distance, side="right")) - 1
+        i = min(i, len(self.distances) - 1)
+        if self.distances[i] == 0:
+            return i, 0.0
+        return i, float((distance - self.cumulative_distances[i]) / self.distances[i])
+
+    def travel_time(self, start_distance: float, end_distance: float, start_time: datetime.datetime) -> float:
+        """Seconds to travel between two distances along the path when setting off at start_time. Each segment is
+        travelled at its speed for the time the vehicle enters it, as a cumulative sum over runs of segments that
+        fall in the same time bin."""
+
+        if end_distance <= start_distance or len(self.distances) == 0:
+            return 0.0
+
+        start_idx, start_fraction = self.position_at_distance(start_distance)
+        end_idx, end_fraction = self.position_at_distance(end_distance)
+
+        segment_distances = self.distances[start_idx:end_idx + 1].copy()
+        segment_distances[-1] *= end_fraction
+        segment_distances[0] -= self.distances[start_idx] * start_fraction
+        speeds = self.speed_table[start_idx:end_idx + 1].reshape(-1, SPEED_BINS_PER_WEEK)
+
+        week_bin, seconds_into_bin = speed_bin(start_time)
+        elapsed = 0.0
+        first = 0
+        while True:
+            segment_times = segment_distances[first:] / speeds[first:, week_bin]
+            enter_times = numpy.cumsum(segment_times) - segment_times
+            # Segments entered after the end of the current bin use the next bin's speeds
+            change = int(numpy.searchsorted(enter_times, SPEED_BIN_SECONDS - seconds_into_bin, side="left"))
+            if change == len(segment_times):
+                return elapsed + float(numpy.sum(segment_times))
+
+            elapsed += float(enter_times[change])
+            bins_passed, seconds_into_bin = divmod(seconds_into_bin + float(enter_times[change]), SPEED_BIN_SECONDS)
+            week_bin = (week_bin + int(bins_passed)) % SPEED_BINS_PER_WEEK
+            first += change
+
+    def stop_travel_times(self, stop_distances: typing.List[float]) -> numpy.ndarray:
+        """Seconds to travel each leg between consecutive stops at the given distances along the path, when setting
+        off in each bin of the week; indexed by [leg, week bin]. Every journey calling at the same stops on this
+        path shares the table, and it goes when the path is rebuilt for new speed data."""
+
+        key = tuple(stop_distances)
+        if (table := self.travel_time_tables.get(key)) is None:
+            table = self.travel_time_tables[key] = self.build_travel_times(numpy.array(stop_distances))
+        return table
+
+    def build_travel_times(self, stop_distances: numpy.ndarray) -> numpy.ndarray:
+        if len(self.distances) == 0:
+            return numpy.zeros((max(len(stop_distances) - 1, 0), SPEED_BINS_PER_WEEK))
+
+        starts = numpy.clip(stop_distances[:-1], 0.0, self.length)
+        ends = numpy.maximum(numpy.clip(stop_distances[1:], 0.0, self.length), starts)
+        # Length of each segment that falls within each leg
+        overlaps = numpy.clip(
+            numpy.minimum(ends[:, numpy.newaxis], self.cumulative_distances[numpy.newaxis, 1:]) -
+            numpy.maximum(starts[:, numpy.newaxis], self.cumulative_distances[numpy.newaxis, :-1]),
+            0.0, None
+        )
+        return overlaps @ (1 / self.speed_table.reshape(-1, SPEED_BINS_PER_WEEK))
+
+    def to_bytes(self) -> bytes:
+        out = io.BytesIO()
+        numpy.savez_compressed(
+            out,
+            lat=self.latitudes,
+            long=self.longitudes,
+            distances=self.distances,
+            speeds=self.speed_table.astype(numpy.float32),
+        )
+        return out.getvalue()
 
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Path":
+        arrays = numpy.load(io.BytesIO(data))
 
-def map_point_speed(average_speeds: typing.List[models.ShapePointAverageSpeed]) -> typing.List[SpeedAtTime]:
-    speed_map = []
-    for speed in average_speeds:
-        speed_map.append(SpeedAtTime(
-            from_time=speed.validity_start_time,
-            to_time=speed.validity_end_time,
-            speed_ms=speed.speed_kmh * consts.KMH_TO_MS
-        ))
+        path = cls(
+            points=[Point(lat=lat, long=long) for lat, long in zip(arrays["lat"], arrays["long"])],
+            speed_table=arrays["speeds"].astype(numpy.float64)
+        )
+        path.set_distances(arrays["distances"])
+        return path
+
+
+def build_speed_table(
+        shape: models.Shape, point_objs: typing.List[models.ShapePoint], reverse: bool = False
+) -> numpy.ndarray:
+    """Speeds in m/s for each segment of the path by day and time. Average speeds are stored against the point at the
+    start of each segment in the shape's own order, with separate rows for travelling the shape in reverse."""
+
+    segments = point_objs[:-1]
+    segment_index = {p.id: i for i, p in enumerate(segments)}
+    speed_table = numpy.empty((len(segments), 7, SPEED_BINS_PER_DAY), dtype=numpy.float64)
+    bin_starts = [datetime.time(*divmod(b * SPEED_BIN_SECONDS // 60, 60)) for b in range(SPEED_BINS_PER_DAY)]
+
+    for i, p in enumerate(segments):
+        speed_table[i] = (p.speed_limit_kmh or DEFAULT_SPEED_KMH) * consts.KMH_TO_MS
+
+    speeds = list(models.ShapePointAverageSpeed.objects.filter(
+        point__shape=shape,
+        direction=models.ShapePointAverageSpeed.DIRECTION_REVERSE if reverse
+        else models.ShapePointAverageSpeed.DIRECTION_FORWARD,
+        speed_kmh__gt=0,
+    ).values_list(
+        "point_id", "speed_kmh", "validity_start_time", "validity_end_time",
+        "valid_monday", "valid_tuesday", "valid_wednesday", "valid_thursday", "valid_friday", "valid_saturday",
+        "valid_sunday",
+    ))
 
-    return speed_map
+    # Where validity periods overlap the first one stored takes precedence, so fill in reverse
+    for point_id, speed_kmh, start, end, *valid_days in reversed(speeds):
+        if point_id not in segment_index:
+            continue
 
+        days = [d for d, valid in enumerate(valid_days) if valid]
+        bins = [b for b, t in enumerate(bin_starts) if start <= t <= end]
+        speed_table[numpy.ix_([segment_index[point_id]], days, bins)] = speed_kmh * consts.KMH_TO_MS
 
+    if reverse:
+        speed_table = numpy.ascontiguousarray(speed_table[::-1])
+
+    return speed_table
+
+
+@telemetry.stage("load_path")
 def load_path(shape: models.Shape, reverse: bool = False) -> Path:
+    """Returns the compiled path for a shape, from the in-process cache, the shared cache, or by building it from
+    the database; in that order."""
+
+    generation = path_cache.shape_generation(shape.id)
+    key = path_cache.path_key(shape.id, reverse, shape.last_average_speed_update, generation)
+    if path := path_cache.get_local(key):
+        return path
+
+    if data := path_cache.get_shared(key):
+        path = Path.from_bytes(data)
+    else:
+        path = build_path(shape, reverse)
+        path_cache.put_shared(key, path.to_bytes())
+
+    path.shape_id = shape.id
+    path.reverse = reverse
+    path.generation = generation
+    path_cache.put_local(key, path)
+    return path
+
+
+def build_path(shape: models.Shape, reverse: bool = False) -> Path:
     point_objs: typing.List[models.ShapePoint] = list(shape.points.order_by('order').all())
     points = [Point(long=p.longitude, lat=p.latitude) for p in point_objs]
 
     if reverse:
         points = points[::-1]
 
-    speeds = []
-    for p in point_objs[:-1]:
-        speeds.append(Speed(
-            monday=map_point_speed(list(p.average_speeds.filter(valid_monday=True))),
-            tuesday=map_point_speed(list(p.average_speeds.filter(valid_tuesday=True))),
-            wednesday=map_point_speed(list(p.average_speeds.filter(valid_wednesday=True))),
-            thursday=map_point_speed(list(p.average_speeds.filter(valid_thursday=True))),
-            friday=map_point_speed(list(p.average_speeds.filter(valid_friday=True))),
-            saturday=map_point_speed(list(p.average_speeds.filter(valid_saturday=True))),
-            sunday=map_point_speed(list(p.average_speeds.filter(valid_sunday=True))),
-            limit_ms=p.speed_limit_kmh * consts.KMH_TO_MS
-        ))
-
     path = Path(
         points=points,
-        speeds=speeds
+        speed_table=build_speed_table(shape, point_objs, reverse)
     )
     path.calculate_distances()
     return path
@@ -198,12 +459,63 @@ class UpdateState:
     journey: typing.Optional[models.Journey] = None
     current_point: typing.Optional[models.JourneyPoint] = None
     path: typing.Optional[Path] = None
+    plan: typing.Optional[day_plan.DayPlan] = None
+
 
+def report_pending_key(vehicle_id: str) -> str:
+    return f"tracking_vehicle_report_pending:{vehicle_id}"
 
-@shared_task(bind=True, ignore_result=True)
-def vehicle_report(self, vehicle_id: str):
+
+def report_dirty_key(vehicle_id: str) -> str:
+    return f"tracking_vehicle_report_dirty:{vehicle_id}"
+
+
+def estimator_service_enabled() -> bool:
+    return getattr(settings, "TRACKING_ESTIMATOR_SERVICE", False)
+
+
+def schedule_vehicle_report(vehicle_id: str):
+    """Queues an estimator run for a vehicle's latest position. If one is already queued or running it's only marked
+    to run again afterwards, so a burst of fixes costs at most two runs."""
+
+    if estimator_service_enabled():
+        # The service does its own coalescing; the notification is only delivered once the position is committed
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [ESTIMATOR_SERVICE_CHANNEL, vehicle_id])
+        return
+
+    if django.core.cache.cache.add(report_pending_key(vehicle_id), True, REPORT_PENDING_TIMEOUT):
+        vehicle_report.apply_async((vehicle_id,), queue=estimator_queue(vehicle_id))
+    else:
+        django.core.cache.cache.set(report_dirty_key(vehicle_id), True, REPORT_PENDING_TIMEOUT)
+        telemetry.increment(REPORTS_COALESCED_KEY)
+
+
+@shared_task(ignore_result=True)
+def vehicle_report(vehicle_id: str):
     """Updates the vehicle arrival estimator based on the latest position report"""
 
+    with vehicle_lock(vehicle_id) as acquired:
+        if not acquired:
+            # A sweep is updating the vehicle's journey; rather than tie the worker up waiting, run again shortly
+            django.core.cache.cache.set(report_pending_key(vehicle_id), True, REPORT_PENDING_TIMEOUT)
+            vehicle_report.apply_async((vehicle_id,), queue=estimator_queue(vehicle_id), countdown=LOCK_RETRY_DELAY)
+            return
+
+        # Anything marked before the position is read below is covered by this run
+        django.core.cache.cache.delete(report_dirty_key(vehicle_id))
+        try:
+            with telemetry.trace("report", vehicle=vehicle_id):
+                process_vehicle_report(vehicle_id)
+        finally:
+            django.core.cache.cache.delete(report_pending_key(vehicle_id))
+
+    # A newer fix arrived while this one was being processed
+    if django.core.cache.cache.get(report_dirty_key(vehicle_id)):
+        schedule_vehicle_report(vehicle_id)
+
+
+def process_vehicle_report(vehicle_id: str):
     vehicle = models.Vehicle.objects.get(id=vehicle_id)
     last_position = vehicle.positions.order_by("-timestamp").first()
     if last_position is None:
@@ -215,82 +527,167 @@ def vehicle_report(self, vehicle_id: str):
         vehicle=vehicle,
         now=now,
         position=position_point,
-        velocity=last_position.velocity_ms
+        velocity=last_position.velocity_ms,
+        plan=day_plan.get_plan(vehicle.id, now.date()),
+        journey=models.Journey.objects.filter(
+            vehicle=vehicle,
+            real_time_state=models.Journey.RT_STATE_ACTIVE
+        ).select_related("shape").first()
     )
-    update_vehicle_journey_from_report(self.app.oid, update_state)
+
+    # A journey that's running is followed to its end however late it is, so only otherwise can the report be idle
+    if not update_state.journey and (reason := idle_reason(update_state)):
+        logging.info(f"Vehicle {vehicle} is idle ({reason}), not running the estimator")
+        telemetry.increment(reports_idle_key(reason))
+        return
+
+    update_vehicle_journey_from_report(update_state)
+
+
+def reports_idle_key(reason: str) -> str:
+    return f"{REPORTS_IDLE_KEY}:{reason}"
+
+
+def idle_journey_window() -> datetime.timedelta:
+    return datetime.timedelta(minutes=getattr(settings, "TRACKING_IDLE_JOURNEY_WINDOW_MINUTES", 15))
+
+
+def idle_reason(update_state: UpdateState) -> typing.Optional[str]:
+    """Why a report from a vehicle without an active journey can be acknowledged without running the estimator, if it
+    can. That's when none of its journeys is timetabled to be running, or to start within the idle window, and it is
+    either parked in a depot or layover geofence or stationary. Journeys are taken to be running until REALTIME_CUTOFF
+    after their scheduled end, and yesterday's are checked too for blocks that run past midnight."""
+
+    window = idle_journey_window()
+    yesterday = day_plan.get_plan(update_state.vehicle.id, (update_state.now - datetime.timedelta(days=1)).date())
+    if any(plan.in_service(update_state.now, window, REALTIME_CUTOFF) for plan in (update_state.plan, yesterday)):
+        return None
+
+    if geofences.in_geofence(update_state.position.lat, update_state.position.long):
+        return "geofence"
+    if update_state.velocity is not None and update_state.velocity < STATIONARY_SPEED_MS:
+        return "stationary"
+    return None
 
 
 @shared_task(ignore_result=True)
 def update_journey_estimates():
+    """Fans the estimate sweep out over the estimator queues in chunks of journeys. Only one sweep is started per
+    interval, however many schedulers fire, and each chunk expires when the next sweep is due."""
+
+    if estimator_service_enabled():
+        return
+
     now = timezone.now()
-    active_journeys = models.Journey.objects.filter(
+    tick = int(now.timestamp())
+    if not django.core.cache.cache.add(
+            f"{ESTIMATE_SWEEP_TICK_KEY}_lock", tick, ESTIMATE_SWEEP_INTERVAL - 1
+    ):
+        logging.info("Journey estimate sweep already started for this interval")
+        return
+
+    django.core.cache.cache.set(ESTIMATE_SWEEP_TICK_KEY, tick, ESTIMATE_SWEEP_INTERVAL * 4)
+
+    queue_journey_ids = collections.defaultdict(list)
+    for journey_id, vehicle_id in models.Journey.objects.filter(
         real_time_state=models.Journey.RT_STATE_ACTIVE
-    )
-    for journey in active_journeys:
-        update_vehicle_journey_from_estimate(journey.id, int(now.timestamp()))
+    ).values_list("id", "vehicle_id"):
+        queue_journey_ids[estimator_queue(vehicle_id or journey_id)].append(str(journey_id))
+
+    deadline = now + datetime.timedelta(seconds=ESTIMATE_SWEEP_INTERVAL)
+    for queue, journey_ids in queue_journey_ids.items():
+        for i in range(0, len(journey_ids), ESTIMATE_SWEEP_CHUNK_SIZE):
+            update_journey_estimates_chunk.apply_async(
+                (journey_ids[i:i + ESTIMATE_SWEEP_CHUNK_SIZE], tick), queue=queue, expires=deadline
+            )
 
 
-@shared_task(bind=True, ignore_result=True)
-def update_vehicle_journey_from_estimate(self, journey_id: str, now: int):
-    now = datetime.datetime.fromtimestamp(now, tz=datetime.timezone.utc)
-    journey = models.Journey.objects.get(id=journey_id)
+@shared_task(ignore_result=True)
+def flush_live_states():
+    live_state.flush_states()
 
-    with memcache_lock(f"journey_update_{journey.id}", self.app.oid) as acquired:
-        if not acquired:
-            logging.info(f"Update lock on journey {journey} held elsewhere")
-            return
 
-        kalman_distance_to_next_stop = kalman_filter_distance_to_next_stop(
-            journey, now, None, None
+def estimate_sweep_superseded(tick: int) -> bool:
+    current_tick = django.core.cache.cache.get(ESTIMATE_SWEEP_TICK_KEY)
+    return current_tick is not None and current_tick > tick
+
+
+@shared_task(ignore_result=True)
+def update_journey_estimates_chunk(journey_ids: typing.List[str], now: int):
+    deadline = now + ESTIMATE_SWEEP_INTERVAL
+    now_dt = datetime.datetime.fromtimestamp(now, tz=datetime.timezone.utc)
+
+    with telemetry.trace("sweep", tick=now, journeys=len(journey_ids)), contextlib.ExitStack() as locks:
+        journeys = []
+        for journey in models.Journey.objects.filter(id__in=journey_ids).select_related("vehicle", "shape"):
+            # A report being processed for the vehicle will update its estimates anyway
+            if locks.enter_context(vehicle_lock(journey.vehicle_id or journey.id)):
+                journeys.append(journey)
+            else:
+                logging.info(f"Estimator lock on journey {journey} held elsewhere")
+
+        update_journeys_from_estimates(
+            journeys, now_dt, overran=lambda: estimate_sweep_superseded(now) or time.time() > deadline
         )
-        if kalman_distance_to_next_stop is None:
-            return
 
-        if journey.vehicle:
-            logging.info(f"Vehicle {journey.vehicle} kalman estimate distance to next stop: "
-                         f"{kalman_distance_to_next_stop:.2f}m")
 
-        next_stop = journey.points.filter(
-            real_time_arrival__isnull=True
-        ).order_by('order').first()
-        if not next_stop:
+def update_journeys_from_estimates(
+        journeys: typing.List[models.Journey], now: datetime.datetime,
+        overran: typing.Callable[[], bool] = lambda: False
+):
+    distances = kalman_predict_journeys(journeys, now)
+
+    for i, journey in enumerate(journeys):
+        if overran():
+            logging.info(f"Journey estimate sweep at {now} overran, skipping {len(journeys) - i} journeys")
             return
 
-        path = load_path(journey.shape, reverse=journey.direction == models.Journey.DIRECTION_OUTBOUND)
+        if journey.id in distances:
+            update_journey_from_estimate(journey, now, distances[journey.id])
 
-        if kalman_distance_to_next_stop <= 0:
-            time_next_stop = now
-        else:
-            time_next_stop = distance_to_next_stop_to_travel_time(
-                path=path, next_point=Point(lat=next_stop.stop.latitude, long=next_stop.stop.longitude),
-                distance_to_next_stop=kalman_distance_to_next_stop, now=now
-            )
-            if journey.vehicle:
-                logging.info(f"Vehicle {journey.vehicle} arrival time at next stop: {time_next_stop}")
 
-        last_stop = journey.points.order_by('order').last()
+def update_journey_from_estimate(
+        journey: models.Journey, now: datetime.datetime, kalman_distance_to_next_stop: float
+):
+    if journey.vehicle:
+        logging.info(f"Vehicle {journey.vehicle} kalman estimate distance to next stop: "
+                     f"{kalman_distance_to_next_stop:.2f}m")
 
-        next_stop.estimated_arrival = time_next_stop.time()
-        if next_stop != last_stop:
-            next_stop.estimated_departure = estimate_departure_time_from_stop(now, next_stop).time()
-        next_stop.save()
+    next_stop = journey.points.filter(
+        real_time_arrival__isnull=True
+    ).order_by('order').first()
+    if not next_stop:
+        return
 
-        if journey.vehicle:
-            log_estimates(journey.vehicle, next_stop)
+    path = load_path(journey.shape, reverse=journey.direction == models.Journey.DIRECTION_OUTBOUND)
 
-        update_future_stops_arrival_time(
-            journey=journey, vehicle=journey.vehicle, path=path, start_stop=next_stop,
-            now=now
+    if kalman_distance_to_next_stop <= 0:
+        time_next_stop = now
+    else:
+        time_next_stop = distance_to_next_stop_to_travel_time(
+            path=path, next_stop_position=get_stop_position(path, next_stop.stop),
+            distance_to_next_stop=kalman_distance_to_next_stop, now=now
         )
+        if journey.vehicle:
+            logging.info(f"Vehicle {journey.vehicle} arrival time at next stop: {time_next_stop}")
 
+    plan = day_plan.get_plan(journey.vehicle_id, now.date())
+
+    next_stop.estimated_arrival = time_next_stop
+    if next_stop.id != plan.last_point_id(journey):
+        next_stop.estimated_departure = estimate_departure_time_from_stop(next_stop)
+    write_estimates([next_stop])
+
+    if journey.vehicle:
+        log_estimates(journey.vehicle, next_stop)
+
+    update_future_stops_arrival_time(
+        journey=journey, vehicle=journey.vehicle, path=path, start_stop=next_stop,
+        now=now
+    )
 
-def update_vehicle_journey_from_report(oid, update_state: UpdateState):
-    update_state.journey = models.Journey.objects.filter(
-        vehicle=update_state.vehicle,
-        date=update_state.now.date(),
-        real_time_state=models.Journey.RT_STATE_ACTIVE
-    ).first()
 
+def update_vehicle_journey_from_report(update_state: UpdateState):
     # Does the vehicle have a currently active journey?
     if not update_state.journey:
         logging.info(f"No active journey for vehicle {update_state.vehicle}; attempting to find stop to start journey from")
@@ -300,156 +697,144 @@ def update_vehicle_journey_from_report(oid, update_state: UpdateState):
             logging.info(f"Cannot find journey for vehicle {update_state.vehicle}")
             return
 
-    while True:
-        with memcache_lock(f"journey_update_{update_state.journey.id}", oid) as acquired:
-            if not acquired:
-                logging.info(f"Update lock on journey {update_state.journey} held elsewhere")
-                time.sleep(1)
-                continue
-
-            # If we don't have know that the vehicle is currently at a stop, find out if it is
-            if not update_state.current_point:
+    # If we don't have know that the vehicle is currently at a stop, find out if it is
+    if not update_state.current_point:
+        update_state.current_point = find_current_journey_point(update_state)
+
+    # If the vehicle is at a stop, update the real-time arrival time if it is not already set
+    if update_state.current_point:
+        if not update_state.current_point.real_time_arrival:
+            update_state.current_point.real_time_arrival = update_state.now
+            update_state.current_point.estimated_arrival = None
+            save_journey_point(update_state.current_point)
+
+    with transaction.atomic():
+        # Is the current stop the last stop on the journey
+        if update_state.current_point and \
+                update_state.plan.last_point_id(update_state.journey) == update_state.current_point.id:
+            logging.info(f"Journey completed for vehicle {update_state.vehicle}: {update_state.journey}")
+            # Mark the journey as finished
+            update_state.journey.real_time_state = models.Journey.RT_STATE_COMPLETED
+            live_state.clear_state(update_state.journey)
+            update_state.journey.save()
+
+            # Does the vehicle have another journey to start?
+            forms_into = update_state.plan.next_journey(update_state.journey)
+            if forms_into:
+                # Set the vehicle's next journey as active
+                forms_into.real_time_state = models.Journey.RT_STATE_ACTIVE
+                forms_into.save()
+                update_state.journey = forms_into
+
+                # Is the vehicle currently at a stop on its next journey?
                 update_state.current_point = find_current_journey_point(update_state)
-
-            # If the vehicle is at a stop, update the real-time arrival time if it is not already set
-            if update_state.current_point:
-                if not update_state.current_point.real_time_arrival:
-                    update_state.current_point.real_time_arrival = update_state.now.time()
+                if update_state.current_point:
+                    update_state.current_point.real_time_arrival = update_state.now
                     update_state.current_point.estimated_arrival = None
-                    update_state.current_point.save()
-
-            with transaction.atomic():
-                # Is the current stop the last stop on the journey
-                if update_state.journey.points.order_by('order').last() == update_state.current_point:
-                    logging.info(f"Journey completed for vehicle {update_state.vehicle}: {update_state.journey}")
-                    # Mark the journey as finished
-                    update_state.journey.real_time_state = models.Journey.RT_STATE_COMPLETED
-                    update_state.journey.kalman_estimator_state = None
-                    update_state.journey.save()
-
-                    # Does the vehicle have another journey to start?
-                    forms_into = update_state.journey.forms_into_opt()
-                    if forms_into:
-                        # Set the vehicle's next journey as active
-                        forms_into.real_time_state = models.Journey.RT_STATE_ACTIVE
-                        forms_into.save()
-                        update_state.journey = forms_into
-
-                        # Is the vehicle currently at a stop on its next journey?
-                        update_state.current_point = find_current_journey_point(update_state)
-                        if update_state.current_point:
-                            update_state.current_point.real_time_arrival = update_state.now.time()
-                            update_state.current_point.estimated_arrival = None
-                            update_state.current_point.save()
-                    else:
-                        # If the vehicle doesn't have a next journey, we are done
-                        return
-
-            if not update_state.journey.shape:
-                logging.info(f"No shape for journey, can't update stop arrival estimates: {update_state.journey}")
+                    save_journey_point(update_state.current_point)
+            else:
+                # If the vehicle doesn't have a next journey, we are done
                 return
 
-            if update_state.journey.shape.points.count() == 0:
-                logging.info(f"Empty shape for journey, can't update stop arrival estimates: {update_state.journey}")
-                return
+    if not update_state.journey.shape:
+        logging.info(f"No shape for journey, can't update stop arrival estimates: {update_state.journey}")
+        return
 
-            update_state.path = load_path(
-                update_state.journey.shape,
-                reverse=update_state.journey.direction == models.Journey.DIRECTION_OUTBOUND
-            )
+    if update_state.journey.shape.points.count() == 0:
+        logging.info(f"Empty shape for journey, can't update stop arrival estimates: {update_state.journey}")
+        return
 
-            # If the vehicle is at a stop, we are done
-            if update_state.current_point:
+    update_state.path = load_path(
+        update_state.journey.shape,
+        reverse=update_state.journey.direction == models.Journey.DIRECTION_OUTBOUND
+    )
 
-                # Estimator state is only used between stops
-                update_state.journey.kalman_estimator_state = None
-                update_state.journey.save()
+    # If the vehicle is at a stop, we are done
+    if update_state.current_point:
 
-                # Update the estimate for when the vehicle with leave the current stop
-                departure_time = estimate_departure_time_from_stop(update_state.now, update_state.current_point)
-                update_state.current_point.estimated_departure = departure_time.time()
-                update_state.current_point.save()
+        # Estimator state is only used between stops
+        live_state.clear_state(update_state.journey)
 
-                log_estimates(update_state.vehicle, update_state.current_point)
+        # Update the estimate for when the vehicle with leave the current stop
+        departure_time = estimate_departure_time_from_stop(update_state.current_point)
+        update_state.current_point.estimated_departure = departure_time
+        write_estimates([update_state.current_point])
 
-                update_future_stops_arrival_time(
-                    journey=update_state.journey, vehicle=update_state.vehicle, path=update_state.path,
-                    start_stop=update_state.current_point, now=departure_time
-                )
-            # If the vehicle is not at a stop, we need to update its distance to the next stop
-            else:
-                last_stop = update_state.journey.points.filter(
-                    real_time_arrival__isnull=False
-                ).order_by('order').last()
-                next_stop = update_state.journey.points.filter(
-                    order__gt=last_stop.order
-                ).order_by('order').first()
-                if not next_stop:
-                    return
+        log_estimates(update_state.vehicle, update_state.current_point)
 
-                update_in_between_stops_estimate(update_state, last_stop, next_stop)
+        update_future_stops_arrival_time(
+            journey=update_state.journey, vehicle=update_state.vehicle, path=update_state.path,
+            start_stop=update_state.current_point, now=departure_time
+        )
+    # If the vehicle is not at a stop, we need to update its distance to the next stop
+    else:
+        last_stop = update_state.journey.points.filter(
+            real_time_arrival__isnull=False
+        ).order_by('order').last()
+        next_stop = update_state.journey.points.filter(
+            order__gt=last_stop.order
+        ).order_by('order').first()
+        if not next_stop:
+            return
 
-            break
+        update_in_between_stops_estimate(update_state, last_stop, next_stop)
 
 
 def select_journey_point(
-        update_state: UpdateState, points: typing.List[models.JourneyPoint], date: datetime.date = None
+        update_state: UpdateState, points: typing.List[models.JourneyPoint]
 ) -> typing.Optional[models.JourneyPoint]:
     """Searches for a stop that is within the search radius of the vehicle's current position and has the closest
      planned arrival / departure time to the current time."""
 
-    date = date or update_state.journey.date
+    points = list(points)
+    if not points:
+        return None
 
-    candidate_points = []
+    time_deltas = []
     for stop in points:
         stop_time = stop.departure_time
         if not stop_time:
             stop_time = stop.arrival_time
 
-        stop_time = datetime.datetime.combine(date, stop_time).astimezone(datetime.timezone.utc)
+        time_deltas.append(abs((stop_time - update_state.now).total_seconds()))
 
-        candidate_points.append({
-            "abs_time_delta": abs((stop_time - update_state.now).total_seconds()),
-            "point": Point(long=stop.stop.longitude, lat=stop.stop.latitude),
-            "obj": stop
-        })
-
-    candidate_points.sort(key=lambda x: x["abs_time_delta"])
+    # Stops are all within the search radius, close enough to measure on a flat projection about the vehicle
+    projection = geodesy.LocalProjection(update_state.position.lat, update_state.position.long)
+    stop_distances = numpy.linalg.norm(projection.to_xy(
+        [stop.stop.latitude for stop in points], [stop.stop.longitude for stop in points]
+    ), axis=-1)
 
     selected_point = None
-    for stop in candidate_points:
-        if update_state.position.distance_to(stop["point"]) < STOP_SEARCH_RADIUS_METERS:
-            selected_point = stop
+    for i in numpy.argsort(time_deltas, kind="stable"):
+        if stop_distances[i] < STOP_SEARCH_RADIUS_METERS:
+            selected_point = points[i]
             break
 
-    return selected_point["obj"] if selected_point else None
+    return selected_point
 
 
 def find_current_journey_point(update_state: UpdateState) -> typing.Optional[models.JourneyPoint]:
     """Finds the current stop that a vehicle is at"""
 
     return select_journey_point(update_state, update_state.journey.points.filter(
+        stop_id__in=nearby_stops(update_state),
         real_time_departure__isnull=True
-    ))
+    ).select_related("stop"))
 
 
-def estimate_departure_time_from_stop(now: datetime.datetime, stop: models.JourneyPoint) -> datetime.datetime:
-    arrival_time = datetime.datetime.combine(
-        now.date(),
-        stop.real_time_arrival if stop.real_time_arrival else (
-            stop.estimated_arrival if stop.estimated_arrival else (
-                stop.arrival_time if stop.arrival_time else stop.departure_time
-            )
-        )
-    )
+def nearby_stops(update_state: UpdateState) -> typing.List[uuid.UUID]:
+    return stop_index.stops_near(update_state.position.lat, update_state.position.long, STOP_SEARCH_RADIUS_METERS)
+
+
+def estimate_departure_time_from_stop(stop: models.JourneyPoint) -> datetime.datetime:
+    arrival_time = stop.real_time_arrival or stop.estimated_arrival or stop.arrival_time or stop.departure_time
 
     possible_departure_times = [arrival_time + MINIMUM_STOP_TIME]
     if stop.timing_point:
         if stop.departure_time:
-            possible_departure_times.append(datetime.datetime.combine(now.date(), stop.departure_time))
+            possible_departure_times.append(stop.departure_time)
         if stop.arrival_time:
-            t = datetime.datetime.combine(now.date(), stop.arrival_time)
-            possible_departure_times.append(t + MINIMUM_STOP_TIME)
+            possible_departure_times.append(stop.arrival_time + MINIMUM_STOP_TIME)
 
     return max(possible_departure_times)
 
@@ -462,18 +847,21 @@ def update_in_between_stops_estimate(
     if not prev_stop.real_time_departure:
         prev_stop.real_time_departure = update_state.now
         prev_stop.estimated_departure = None
-        prev_stop.save()
+        save_journey_point(prev_stop)
 
-    next_point = Point(long=next_stop.stop.longitude, lat=next_stop.stop.latitude)
-    path_start_point_idx, distance_along_start_segment = \
-        find_point_on_path(update_state.position, update_state.path)
-    path_end_point_idx, distance_along_end_segment = find_point_on_path(next_point, update_state.path)
+    prev_stop_position, next_stop_position = get_stop_positions(update_state.path, [prev_stop.stop, next_stop.stop])
+    with telemetry.stage("find_point_on_path"):
+        vehicle_projection = update_state.path.project(
+            update_state.position, min_distance=prev_stop_position.distance_along
+        )
+
+    distance_to_next_stop = next_stop_position.distance_along - vehicle_projection.distance_along
 
-    if path_start_point_idx >= path_end_point_idx:
+    if distance_to_next_stop <= 0:
         logging.info(f"Vehicle {update_state.vehicle} has passed stop {next_stop.stop} without updates")
-        next_stop.real_time_arrival = update_state.now.time()
+        next_stop.real_time_arrival = update_state.now
         next_stop.estimated_arrival = None
-        next_stop.save()
+        save_journey_point(next_stop)
 
         prev_stop = next_stop
         next_stop = update_state.journey.points.filter(
@@ -484,14 +872,6 @@ def update_in_between_stops_estimate(
 
         return
 
-    distance_to_next_stop = update_state.path.distances[path_start_point_idx] * distance_along_start_segment
-    i = path_start_point_idx + 1
-    while i != path_end_point_idx:
-        distance_to_next_stop += update_state.path.distances[i]
-        i += 1
-    if path_end_point_idx + 1 != len(update_state.path.points):
-        distance_to_next_stop += update_state.path.distances[path_end_point_idx ] * distance_along_end_segment
-
     logging.info(f"Vehicle {update_state.vehicle} distance to next stop: {distance_to_next_stop:.2f}m")
 
     kalman_distance_to_next_stop = kalman_filter_distance_to_next_stop(
@@ -501,16 +881,14 @@ def update_in_between_stops_estimate(
     logging.info(f"Vehicle {update_state.vehicle} kalman estimate distance to next stop: {kalman_distance_to_next_stop:.2f}m")
 
     time_next_stop = distance_to_next_stop_to_travel_time(
-        path=update_state.path, next_point=next_point, distance_to_next_stop=kalman_distance_to_next_stop,
-        now=update_state.now
+        path=update_state.path, next_stop_position=next_stop_position,
+        distance_to_next_stop=kalman_distance_to_next_stop, now=update_state.now
     )
 
-    last_stop = update_state.journey.points.order_by('order').last()
-
-    next_stop.estimated_arrival = time_next_stop.time()
-    if next_stop != last_stop:
-        next_stop.estimated_departure = estimate_departure_time_from_stop(update_state.now, next_stop).time()
-    next_stop.save()
+    next_stop.estimated_arrival = time_next_stop
+    if next_stop.id != update_state.plan.last_point_id(update_state.journey):
+        next_stop.estimated_departure = estimate_departure_time_from_stop(next_stop)
+    write_estimates([next_stop])
 
     log_estimates(update_state.vehicle, next_stop)
 
@@ -520,6 +898,7 @@ def update_in_between_stops_estimate(
     )
 
 
+@telemetry.stage("kalman")
 def kalman_filter_distance_to_next_stop(
         journey: models.Journey,
         now: datetime.datetime,
@@ -527,95 +906,76 @@ def kalman_filter_distance_to_next_stop(
         known_distance_to_next_stop: typing.Optional[float]
 ) -> typing.Optional[float]:
     t = int(now.timestamp())
+    state = live_state.get_state(journey)
 
-    if not journey.kalman_estimator_state:
+    if not state:
         if not last_known_velocity or not known_distance_to_next_stop:
             return None
 
-        journey.kalman_estimator_state = {
-            "p": 0,
-            "x": known_distance_to_next_stop,
-            "u": last_known_velocity,
-            "t": t,
-        }
-        journey.save()
+        # A new filter starts as the vehicle leaves a stop, so make sure the database copy follows it
+        states = kalman.FilterStates.initial(known_distance_to_next_stop, last_known_velocity, t)
+        live_state.set_state(journey, states.to_dicts()[0], force_flush=True)
 
         return known_distance_to_next_stop
-    else:
-        if known_distance_to_next_stop:
-            p_prev = journey.kalman_estimator_state["p"]
-            x_prev = journey.kalman_estimator_state["x"]
-
-            p1 = p_prev + GPS_VARIANCE
-            b = p1 * (1/(p1 + GPS_VARIANCE))
-            p = p1 - b * p1
-            x = x_prev + b * (known_distance_to_next_stop - x_prev)
-
-            journey.kalman_estimator_state = {
-                "p": p,
-                "x": x,
-                "u": last_known_velocity or journey.kalman_estimator_state["u"],
-                "t": t,
-            }
-            journey.save()
-
-            return x
-        else:
-            if journey.kalman_estimator_state["x"] <= 0:
-                return 0
 
-            t_delta = t - journey.kalman_estimator_state["t"]
-            journey.kalman_estimator_state = {
-                "x": journey.kalman_estimator_state["x"] - t_delta * journey.kalman_estimator_state["u"],
-                "p": journey.kalman_estimator_state["p"] + GPS_VARIANCE,
-                "u": journey.kalman_estimator_state["u"],
-                "t": t,
-            }
-            journey.save()
+    before = kalman.FilterStates.from_dicts([state])
+    states = kalman.predict(before, t)
+    if known_distance_to_next_stop:
+        states = kalman.update_distance(states, numpy.array([known_distance_to_next_stop]))
+        if last_known_velocity:
+            states = kalman.update_velocity(states, numpy.array([last_known_velocity]))
+        states.t[:] = t
 
-            return max(journey.kalman_estimator_state["x"], 0)
+    if kalman.changed(before, states)[0]:
+        live_state.set_state(journey, states.to_dicts()[0])
 
+    return max(float(states.x[0]), 0)
 
-def distance_to_next_stop_to_travel_time(
-        path: Path, next_point: Point, distance_to_next_stop: float, now: datetime.datetime
-) -> datetime.datetime:
-    path_end_point_idx, distance_along_end_segment = find_point_on_path(next_point, path)
 
-    if path_end_point_idx == len(path.points) - 1:
-        distance = 0
-    else:
-        distance = path.distances[path_end_point_idx] * distance_along_end_segment
+@telemetry.stage("kalman")
+def kalman_predict_journeys(
+        journeys: typing.List[models.Journey], now: datetime.datetime
+) -> typing.Dict[typing.Any, float]:
+    """Advances the filter of every journey that has one to now in a single step, returning the estimated distance to
+    the next stop for each. Only states that moved are written back."""
 
-    i = path_end_point_idx - 1
-    while distance < distance_to_next_stop:
-        distance += path.distances[i]
+    journey_states = live_state.get_states(journeys)
+    journeys = [journey for journey in journeys if journey.id in journey_states]
+    if not journeys:
+        return {}
 
-    if distance == distance_to_next_stop:
-        distance_along_start_segment = 0
-    else:
-        distance_along_start_segment = (distance - distance_to_next_stop) - path.distances[i]
+    before = kalman.FilterStates.from_dicts([journey_states[journey.id] for journey in journeys])
+    after = kalman.predict(before, int(now.timestamp()))
 
-    return estimate_time_along_path_segment(
-        path=path, now=now, start_point_idx=i, end_point_idx=path_end_point_idx,
-        distance_along_start_segment=distance_along_start_segment,
-        distance_along_end_segment=distance_along_end_segment
-    )
+    live_state.set_states([
+        (journey, state) for journey, state, changed in zip(journeys, after.to_dicts(), kalman.changed(before, after))
+        if changed
+    ])
 
+    return {journey.id: max(float(x), 0) for journey, x in zip(journeys, after.x)}
 
-def find_current_journey(update_state: UpdateState):
-    journeys_on_date = list(models.Journey.objects.filter(
-        vehicle=update_state.vehicle,
-        date=update_state.now.date()
-    ))
 
-    if not journeys_on_date:
-        logging.info(f"No journeys on date for vehicle - {update_state.vehicle}")
+def distance_to_next_stop_to_travel_time(
+        path: Path, next_stop_position: StopPosition, distance_to_next_stop: float, now: datetime.datetime
+) -> datetime.datetime:
+    start_distance = next_stop_position.distance_along - distance_to_next_stop
+    travel_time = path.travel_time(start_distance, next_stop_position.distance_along, now)
+    return now + datetime.timedelta(seconds=travel_time)
+
+
+@telemetry.stage("find_current_journey")
+def find_current_journey(update_state: UpdateState):
+    # Only stops in range can be where the vehicle is, so the schedule only needs checking for those
+    stop_ids = nearby_stops(update_state)
+    if not stop_ids:
+        logging.info(f"No stops near vehicle - {update_state.vehicle}")
         return
 
     selected_point = select_journey_point(update_state, models.JourneyPoint.objects.filter(
-        journey__in=journeys_on_date,
+        journey_id__in=update_state.plan.journey_ids,
+        stop_id__in=stop_ids,
         real_time_departure__isnull=True
-    ), date=update_state.now.date())
+    ).select_related("stop", "journey"))
 
     if selected_point is None:
         logging.info(f"Cannot find current journey point for vehicle - {update_state.vehicle}")
@@ -631,98 +991,221 @@ def find_current_journey(update_state: UpdateState):
     update_state.journey = current_journey
 
 
+@telemetry.stage("find_point_on_path")
 def find_point_on_path(search_point: Point, path: Path) -> typing.Tuple[int, float]:
-    closest_points = path.get_closest_points(search_point, k=3)
+    projection = path.project(search_point)
+    return projection.segment_index, projection.fraction
 
-    line_candidates = []
-    for point, point_idx in closest_points:
-        if point_idx + 1 == len(path.points):
-            end_point = path.points[point_idx - 1]
-        else:
-            end_point = path.points[point_idx + 1]
 
-        line = shapely.LineString([point.point, end_point.point])
-        distance = shapely.hausdorff_distance(line, search_point.point, densify=0.5)
-        line_candidates.append((line, point_idx, distance))
+def stop_position_key(stop: models.Stop) -> typing.Tuple[uuid.UUID, float, float]:
+    return stop.id, stop.latitude, stop.longitude
+
+
+def get_stop_positions(path: Path, stops: typing.List[models.Stop]) -> typing.List[StopPosition]:
+    """Returns where each stop lies along the path. Stops don't move along a shape, so projections are persisted
+    and only calculated for stops that don't yet have one. Persisted projections are stamped with the generation of
+    the geometry they came from, so one written from a path that has since been edited is never read back."""
+
+    missing = {stop_position_key(stop): stop for stop in stops if stop_position_key(stop) not in path.stop_positions}
 
-    line_candidates.sort(key=lambda x: x[2])
-    closest_line, point_idx, _ = line_candidates[0]
-    distance_along_segment = closest_line.project(search_point.point, normalized=True)
+    if missing and path.shape_id and path.generation:
+        direction = models.ShapeStopProjection.DIRECTION_REVERSE if path.reverse \
+            else models.ShapeStopProjection.DIRECTION_FORWARD
+        stops_by_id = {stop.id: stop for stop in missing.values()}
+
+        for projection in models.ShapeStopProjection.objects.filter(
+                shape_id=path.shape_id, direction=direction, generation=path.generation, stop_id__in=stops_by_id.keys()
+        ):
+            key = stop_position_key(stops_by_id[projection.stop_id])
+            path.stop_positions[key] = StopPosition(
+                segment_index=projection.segment_index,
+                fraction=projection.fraction,
+                distance_along=projection.distance_along
+            )
+            missing.pop(key)
+
+        new_projections = []
+        for key, stop in missing.items():
+            path.stop_positions[key] = project_stop(path, stop)
+            new_projections.append(models.ShapeStopProjection(
+                shape_id=path.shape_id,
+                stop=stop,
+                direction=direction,
+                segment_index=path.stop_positions[key].segment_index,
+                fraction=path.stop_positions[key].fraction,
+                distance_along=path.stop_positions[key].distance_along,
+                generation=path.generation
+            ))
+
+        if new_projections:
+            models.ShapeStopProjection.objects.filter(
+                shape_id=path.shape_id, direction=direction, stop_id__in=[p.stop_id for p in new_projections]
+            ).exclude(generation=path.generation).delete()
+            models.ShapeStopProjection.objects.bulk_create(new_projections, ignore_conflicts=True)
+    else:
+        for key, stop in missing.items():
+            path.stop_positions[key] = project_stop(path, stop)
+
+    return [path.stop_positions[stop_position_key(stop)] for stop in stops]
 
-    return point_idx, distance_along_segment
 
+def get_stop_position(path: Path, stop: models.Stop) -> StopPosition:
+    return get_stop_positions(path, [stop])[0]
+
+
+def project_stop(path: Path, stop: models.Stop) -> StopPosition:
+    path_point_idx, distance_along_segment = find_point_on_path(Point(long=stop.longitude, lat=stop.latitude), path)
+    return StopPosition(
+        segment_index=path_point_idx,
+        fraction=distance_along_segment,
+        distance_along=path.distance_along(path_point_idx, distance_along_segment)
+    )
 
+
+@telemetry.stage("future_stops")
 def update_future_stops_arrival_time(
         journey: models.Journey, vehicle: typing.Optional[models.Vehicle], path: Path,
         start_stop: models.JourneyPoint, now: datetime.datetime
 ):
-    next_stop: typing.Optional[models.JourneyPoint] = journey.points.filter(
+    """Estimates the arrival and departure times of every stop after start_stop in a single pass, and saves them
+    all in one query. Each leg's time is looked up for the hour the vehicle sets off on it, rather than integrated
+    along the path."""
+
+    future_stops: typing.List[models.JourneyPoint] = list(journey.points.filter(
         order__gt=start_stop.order
-    ).order_by('order').first()
-    last_stop = journey.points.order_by('order').last()
-    if not next_stop:
+    ).select_related('stop').order_by('order'))
+    if not future_stops:
+        propagate_block_delay(journey, start_stop.real_time_arrival or start_stop.estimated_arrival, now)
         return
 
-    start_point = Point(long=start_stop.stop.longitude, lat=start_stop.stop.latitude)
-    next_point = Point(long=next_stop.stop.longitude, lat=next_stop.stop.latitude)
+    leg_times = path.stop_travel_times([p.distance_along for p in get_stop_positions(
+        path, [start_stop.stop] + [stop.stop for stop in future_stops]
+    )])
 
-    path_start_point_idx, distance_along_start_segment = find_point_on_path(start_point, path)
-    path_end_point_idx, distance_along_end_segment = find_point_on_path(next_point, path)
+    departure_time = max(estimate_departure_time_from_stop(start_stop), now)
+    for i, next_stop in enumerate(future_stops):
+        week_bin, _ = speed_bin(departure_time)
+        next_stop.estimated_arrival = departure_time + datetime.timedelta(seconds=float(leg_times[i, week_bin]))
 
-    estimate_timestamp = estimate_departure_time_from_stop(now, start_stop)
-    estimate_timestamp = estimate_time_along_path_segment(
-        path, estimate_timestamp, path_start_point_idx, path_end_point_idx,
-        distance_along_start_segment, distance_along_end_segment
-    )
+        if i == len(future_stops) - 1:
+            next_stop.estimated_departure = None
+        else:
+            next_stop.estimated_departure = estimate_departure_time_from_stop(next_stop)
+            departure_time = next_stop.estimated_departure
 
-    next_stop.estimated_arrival = estimate_timestamp.time()
-    if next_stop != last_stop:
-        next_time = estimate_departure_time_from_stop(now, next_stop)
-        next_stop.estimated_departure = next_time.time()
-    else:
-        next_time = estimate_timestamp
-        next_stop.estimated_departure = None
-    next_stop.save()
+        if vehicle:
+            log_estimates(vehicle, next_stop)
 
-    if vehicle:
-        log_estimates(vehicle, next_stop)
+    write_estimates(future_stops)
+    propagate_block_delay(journey, future_stops[-1].estimated_arrival, now)
 
-    update_future_stops_arrival_time(
-        journey=journey, vehicle=vehicle, path=path, start_stop=next_stop, now=next_time
-    )
 
+def propagate_block_delay(
+        journey: models.Journey, terminus_arrival: typing.Optional[datetime.datetime], now: datetime.datetime
+):
+    """Carries the delay at the end of a journey through the journeys the vehicle runs after it, reading and saving
+    all their stops in one go. Each journey can't leave until MINIMUM_LAYOVER after the vehicle reaches the end of
+    the one before, and from there runs to its scheduled times; dwells longer than the schedule's recover some of the
+    delay. Stops the delay doesn't reach have their estimates cleared, as the schedule stands."""
 
-def travel_time_segment(path: Path, start_point_idx: int, now: datetime.datetime, fraction: float = 1) -> float:
-    speed_start_segment = path.speeds[start_point_idx].average_speed_at_time(now)
-    travel_time_start_segment = (path.distances[start_point_idx] * fraction) / speed_start_segment
-    return travel_time_start_segment
+    if not terminus_arrival:
+        return
 
+    following_ids = day_plan.get_plan(journey.vehicle_id, now.date()).following_journey_ids(journey)
+    if not following_ids:
+        return
 
-def estimate_time_along_path_segment(
-        path: Path,
-        now: datetime.datetime,
-        start_point_idx: int,
-        end_point_idx: int,
-        distance_along_start_segment: float = 0,
-        distance_along_end_segment: float = 1,
-) -> datetime.datetime:
-    travel_time_start_segment = travel_time_segment(
-        path, start_point_idx, now, (1 - distance_along_start_segment)
-    )
-    now += datetime.timedelta(seconds=travel_time_start_segment)
-    i = start_point_idx + 1
-    while i != end_point_idx:
-        travel_time = travel_time_segment(path, i, now)
-        now += datetime.timedelta(seconds=travel_time)
-        i += 1
-
-    if end_point_idx + 1 != len(path.points):
-        travel_time_end_segment = travel_time_segment(
-            path, end_point_idx, now, distance_along_end_segment
+    points_by_journey = collections.defaultdict(list)
+    for point in models.JourneyPoint.objects.filter(
+            journey_id__in=following_ids, journey__real_time_state=models.Journey.RT_STATE_PLANNED
+    ).order_by('order'):
+        points_by_journey[point.journey_id].append(point)
+
+    propagated = []
+    ready_time = terminus_arrival + MINIMUM_LAYOVER
+    for journey_id in following_ids:
+        points = points_by_journey.get(journey_id)
+        # A journey that has started, or been cancelled, breaks the chain
+        if not points:
+            break
+
+        delay = max(ready_time - (points[0].departure_time or points[0].arrival_time), datetime.timedelta(0))
+        for i, point in enumerate(points):
+            scheduled_arrival = point.arrival_time or point.departure_time
+            scheduled_departure = point.departure_time or point.arrival_time
+
+            point.estimated_arrival = scheduled_arrival + delay if delay else None
+            delay = max(delay - (scheduled_departure - scheduled_arrival), datetime.timedelta(0))
+            point.estimated_departure = scheduled_departure + delay if delay and i < len(points) - 1 else None
+
+        ready_time = (points[-1].estimated_arrival or points[-1].arrival_time or points[-1].departure_time) \
+            + MINIMUM_LAYOVER
+        propagated.extend(points)
+
+    write_estimates(propagated)
+
+
+def estimate_write_threshold() -> float:
+    return getattr(settings, "TRACKING_ESTIMATE_WRITE_THRESHOLD_SECONDS", 5)
+
+
+def estimate_changed(old: typing.Optional[datetime.datetime], new: typing.Optional[datetime.datetime]) -> bool:
+    if old is None or new is None:
+        return old is not new
+
+    return abs((new - old).total_seconds()) >= estimate_write_threshold()
+
+
+def write_estimates(points: typing.List[models.JourneyPoint]):
+    if estimate_buffer is not None:
+        estimate_buffer.update((point.id, point) for point in points)
+        return
+
+    save_estimates(points)
+
+
+def save_journey_point(point: models.JourneyPoint):
+    """Saves a journey point directly, dropping any of its estimates still waiting in the buffer so that a later flush
+    can't write them back over the real-time times."""
+
+    if estimate_buffer is not None:
+        estimate_buffer.pop(point.id, None)
+    point.save()
+
+
+def flush_estimate_buffer():
+    if estimate_buffer:
+        points = list(estimate_buffer.values())
+        estimate_buffer.clear()
+        save_estimates(points)
+
+
+def save_estimates(points: typing.List[models.JourneyPoint]):
+    """Saves the estimated times of journey points that have moved by at least the threshold since they were
+    loaded, writing only the fields that did. Rows with no such change aren't written at all."""
+
+    to_write = collections.defaultdict(list)
+    suppressed = 0
+    for point in points:
+        loaded = getattr(point, "_loaded_estimates", (None, None))
+        fields = tuple(
+            field for field, old in zip(ESTIMATE_FIELDS, loaded) if estimate_changed(old, getattr(point, field))
         )
-        now += datetime.timedelta(seconds=travel_time_end_segment)
+        if fields:
+            to_write[fields].append(point)
+        else:
+            suppressed += 1
+
+    for fields, fields_points in to_write.items():
+        models.JourneyPoint.objects.bulk_update(fields_points, fields)
+        for point in fields_points:
+            point._loaded_estimates = tuple(
+                getattr(point, field) if field in fields else old
+                for field, old in zip(ESTIMATE_FIELDS, getattr(point, "_loaded_estimates", (None, None)))
+            )
 
-    return now
+    if suppressed:
+        telemetry.increment(ESTIMATE_WRITES_SUPPRESSED_KEY, suppressed)
 
 
 def log_estimates(vehicle: models.Vehicle, stop: models.JourneyPoint):
@@ -0,0 +1,86 @@
+import numpy
+import numpy.typing
+
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+
+VINCENTY_MAX_ITERATIONS = 100
+VINCENTY_TOLERANCE = 1e-12
+
+ArrayLike = numpy.typing.ArrayLike
+
+
+def distances(lat1: ArrayLike, long1: ArrayLike, lat2: ArrayLike, long2: ArrayLike) -> numpy.ndarray:
+    """Geodesic distances in metres on the WGS84 ellipsoid between each pair of points, using Vincenty's inverse
+    formula over whole arrays at once. Inputs are in degrees and broadcast against each other."""
+
+    lat1, long1, lat2, long2 = numpy.broadcast_arrays(
+        *(numpy.radians(numpy.asarray(v, dtype=numpy.float64)) for v in (lat1, long1, lat2, long2))
+    )
+
+    big_l = long2 - long1
+    u1 = numpy.arctan((1 - WGS84_F) * numpy.tan(lat1))
+    u2 = numpy.arctan((1 - WGS84_F) * numpy.tan(lat2))
+    sin_u1, cos_u1 = numpy.sin(u1), numpy.cos(u1)
+    sin_u2, cos_u2 = numpy.sin(u2), numpy.cos(u2)
+
+    lam = big_l
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        for _ in range(VINCENTY_MAX_ITERATIONS):
+            sin_lam, cos_lam = numpy.sin(lam), numpy.cos(lam)
+            sin_sigma = numpy.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = numpy.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = numpy.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            # Equatorial lines have cos_sq_alpha = 0
+            cos_2_sigma_m = numpy.where(cos_sq_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos_sq_alpha)
+            c = WGS84_F / 16 * cos_sq_alpha * (4 + WGS84_F * (4 - 3 * cos_sq_alpha))
+            lam_prev = lam
+            lam = big_l + (1 - c) * WGS84_F * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2_sigma_m + c * cos_sigma * (-1 + 2 * cos_2_sigma_m ** 2))
+            )
+            if not numpy.any(numpy.abs(lam - lam_prev) > VINCENTY_TOLERANCE):
+                break
+
+    u_sq = cos_sq_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = b * sin_sigma * (cos_2_sigma_m + b / 4 * (
+        cos_sigma * (-1 + 2 * cos_2_sigma_m ** 2) -
+        b / 6 * cos_2_sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2_sigma_m ** 2)
+    ))
+
+    return WGS84_B * a * (sigma - delta_sigma)
+
+
+def segment_lengths(lat: ArrayLike, long: ArrayLike) -> numpy.ndarray:
+    """Lengths in metres of each segment of a polyline"""
+
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    long = numpy.asarray(long, dtype=numpy.float64)
+    return distances(lat[:-1], long[:-1], lat[1:], long[1:])
+
+
+class LocalProjection:
+    """Flat east/north projection in metres about an origin, using the ellipsoid's radii of curvature there. The east
+    scale is off by about tan(latitude) times the change in latitude (around 0.3% at 15km north or south in the UK),
+    so it's for short local measurements such as cross track error and search radii; lengths along a path should
+    still come from geodesic distances."""
+
+    def __init__(self, origin_lat: float, origin_long: float):
+        self.origin_lat = origin_lat
+        self.origin_long = origin_long
+
+        lat = numpy.radians(origin_lat)
+        e_sq = WGS84_F * (2 - WGS84_F)
+        w = numpy.sqrt(1 - e_sq * numpy.sin(lat) ** 2)
+        # Metres per radian north (meridional radius) and east (prime vertical radius scaled to the parallel)
+        self.north_scale = WGS84_A * (1 - e_sq) / w ** 3
+        self.east_scale = WGS84_A / w * numpy.cos(lat)
+
+    def to_xy(self, lat: ArrayLike, long: ArrayLike) -> numpy.ndarray:
+        x = numpy.radians(numpy.asarray(long, dtype=numpy.float64) - self.origin_long) * self.east_scale
+        y = numpy.radians(numpy.asarray(lat, dtype=numpy.float64) - self.origin_lat) * self.north_scale
+        return numpy.stack((x, y), axis=-1)
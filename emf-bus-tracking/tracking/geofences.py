@@ -0,0 +1,43 @@
+import threading
+import typing
+import numpy
+from . import models, path_cache, geodesy
+
+
+class GeofenceIndex:
+    """Depot and layover areas, for checking whether a vehicle is parked up"""
+
+    def __init__(self, geofences: typing.List[typing.Tuple[float, float, float]]):
+        self.latitudes = numpy.array([lat for lat, _, _ in geofences], dtype=numpy.float64)
+        self.longitudes = numpy.array([long for _, long, _ in geofences], dtype=numpy.float64)
+        self.radii = numpy.array([radius for _, _, radius in geofences], dtype=numpy.float64)
+
+    def __len__(self):
+        return len(self.radii)
+
+    def contains(self, lat: float, long: float) -> bool:
+        if not len(self.radii):
+            return False
+
+        return bool(numpy.any(geodesy.distances(lat, long, self.latitudes, self.longitudes) <= self.radii))
+
+
+_index = None
+_index_generation = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> GeofenceIndex:
+    global _index, _index_generation
+
+    generation = path_cache.geofences_generation()
+    with _index_lock:
+        if _index is None or _index_generation != generation:
+            _index = GeofenceIndex(list(models.Geofence.objects.values_list("latitude", "longitude", "radius_meters")))
+            _index_generation = generation
+
+        return _index
+
+
+def in_geofence(lat: float, long: float) -> bool:
+    return get_index().contains(lat, long)
@@ -0,0 +1,105 @@
+import dataclasses
+import typing
+import numpy
+
+# Variance of a distance along the path measured from a GPS fix (m²)
+GPS_VARIANCE = 2.5
+# Variance of the speed reported by the tracker ((m/s)²)
+VELOCITY_VARIANCE = 1.0
+# Process noise; how much a bus's speed is expected to wander ((m/s²)²)
+ACCELERATION_VARIANCE = 0.1
+
+
+@dataclasses.dataclass
+class FilterStates:
+    """Filter states for many journeys as parallel arrays. x is the distance left to the next stop and u the speed
+    towards it, with the covariance between them kept as its three distinct terms."""
+
+    x: numpy.ndarray
+    u: numpy.ndarray
+    p_xx: numpy.ndarray
+    p_xu: numpy.ndarray
+    p_uu: numpy.ndarray
+    t: numpy.ndarray
+
+    def __len__(self):
+        return len(self.x)
+
+    @classmethod
+    def from_dicts(cls, states: typing.List[dict]) -> "FilterStates":
+        # States saved before velocity was tracked have a single variance for the distance
+        p = [s["p"] if isinstance(s["p"], list) else [s["p"], 0.0, VELOCITY_VARIANCE] for s in states]
+        p = numpy.array(p, dtype=numpy.float64).reshape(-1, 3)
+        return cls(
+            x=numpy.array([s["x"] for s in states], dtype=numpy.float64),
+            u=numpy.array([s["u"] for s in states], dtype=numpy.float64),
+            p_xx=p[:, 0], p_xu=p[:, 1], p_uu=p[:, 2],
+            t=numpy.array([s["t"] for s in states], dtype=numpy.int64),
+        )
+
+    @classmethod
+    def initial(cls, distance: float, velocity: float, t: int) -> "FilterStates":
+        return cls.from_dicts([{"x": distance, "u": velocity, "p": [GPS_VARIANCE, 0.0, VELOCITY_VARIANCE], "t": t}])
+
+    def to_dicts(self) -> typing.List[dict]:
+        return [{
+            "x": float(self.x[i]),
+            "u": float(self.u[i]),
+            "p": [float(self.p_xx[i]), float(self.p_xu[i]), float(self.p_uu[i])],
+            "t": int(self.t[i]),
+        } for i in range(len(self))]
+
+
+def predict(states: FilterStates, t: int) -> FilterStates:
+    """Advances every state to time t with a constant velocity model. Vehicles that have already reached the stop
+    are held there."""
+
+    dt = numpy.maximum(t - states.t, 0).astype(numpy.float64)
+    moving = states.x > 0
+    dt = numpy.where(moving, dt, 0.0)
+    q = ACCELERATION_VARIANCE
+
+    return FilterStates(
+        x=numpy.where(moving, states.x - dt * states.u, states.x),
+        u=states.u,
+        p_xx=states.p_xx - 2 * dt * states.p_xu + dt ** 2 * states.p_uu + q * dt ** 4 / 4,
+        p_xu=states.p_xu - dt * states.p_uu - q * dt ** 3 / 2,
+        p_uu=states.p_uu + q * dt ** 2,
+        t=numpy.where(moving, t, states.t),
+    )
+
+
+def update_distance(states: FilterStates, distance: numpy.ndarray) -> FilterStates:
+    s = states.p_xx + GPS_VARIANCE
+    k_x = states.p_xx / s
+    k_u = states.p_xu / s
+    y = distance - states.x
+
+    return FilterStates(
+        x=states.x + k_x * y,
+        u=states.u + k_u * y,
+        p_xx=(1 - k_x) * states.p_xx,
+        p_xu=(1 - k_x) * states.p_xu,
+        p_uu=states.p_uu - k_u * states.p_xu,
+        t=states.t,
+    )
+
+
+def update_velocity(states: FilterStates, velocity: numpy.ndarray) -> FilterStates:
+    s = states.p_uu + VELOCITY_VARIANCE
+    k_x = states.p_xu / s
+    k_u = states.p_uu / s
+    y = velocity - states.u
+
+    return FilterStates(
+        x=states.x + k_x * y,
+        u=states.u + k_u * y,
+        p_xx=states.p_xx - k_x * states.p_xu,
+        p_xu=(1 - k_u) * states.p_xu,
+        p_uu=(1 - k_u) * states.p_uu,
+        t=states.t,
+    )
+
+
+def changed(before: FilterStates, after: FilterStates) -> numpy.ndarray:
+    return (before.t != after.t) | (before.x != after.x)
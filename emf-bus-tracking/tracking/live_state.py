@@ -0,0 +1,84 @@
+import typing
+from django.core.cache import cache
+from . import models
+
+LIVE_STATE_TIMEOUT = 60 * 60 * 6
+# How often the latest states are written through to the database
+LIVE_STATE_FLUSH_INTERVAL = 60
+
+
+def state_key(journey_id) -> str:
+    return f"tracking_live_state:{journey_id}"
+
+
+def get_states(journeys: typing.List[models.Journey]) -> typing.Dict[typing.Any, dict]:
+    """Current estimator state for each journey that has one. The cache holds the live copy; if that has been lost
+    (restart, eviction) the last copy written through to the database is used instead."""
+
+    keys = {state_key(journey.id): journey for journey in journeys}
+    cached = cache.get_many(keys.keys())
+
+    states = {}
+    recovered = {}
+    for key, journey in keys.items():
+        state = cached.get(key)
+        if state is None and journey.kalman_estimator_state:
+            state = recovered[key] = journey.kalman_estimator_state
+        if state is not None:
+            states[journey.id] = state
+
+    if recovered:
+        cache.set_many(recovered, LIVE_STATE_TIMEOUT)
+
+    return states
+
+
+def get_state(journey: models.Journey) -> typing.Optional[dict]:
+    return get_states([journey]).get(journey.id)
+
+
+def set_states(journey_states: typing.List[typing.Tuple[models.Journey, dict]], force_flush: bool = False):
+    if not journey_states:
+        return
+
+    cache.set_many({state_key(journey.id): state for journey, state in journey_states}, LIVE_STATE_TIMEOUT)
+
+    # Otherwise left for flush_states to write at the end of the interval
+    if force_flush:
+        for journey, state in journey_states:
+            journey.kalman_estimator_state = state
+        models.Journey.objects.bulk_update([journey for journey, _ in journey_states], ["kalman_estimator_state"])
+
+
+def set_state(journey: models.Journey, state: dict, force_flush: bool = False):
+    set_states([(journey, state)], force_flush=force_flush)
+
+
+def flush_states():
+    """Writes the latest state of every active journey through to the database, where it has changed since the last
+    flush. Run every LIVE_STATE_FLUSH_INTERVAL, so losing the cache loses at most that much of the filters' history."""
+
+    journeys = list(models.Journey.objects.filter(
+        real_time_state=models.Journey.RT_STATE_ACTIVE
+    ).only("id", "kalman_estimator_state"))
+    cached = cache.get_many([state_key(journey.id) for journey in journeys])
+
+    to_flush = []
+    for journey in journeys:
+        state = cached.get(state_key(journey.id))
+        if state is not None and state != journey.kalman_estimator_state:
+            journey.kalman_estimator_state = state
+            to_flush.append(journey)
+
+    if to_flush:
+        models.Journey.objects.bulk_update(to_flush, ["kalman_estimator_state"])
+
+
+def clear_state(journey: models.Journey):
+    had_state = cache.get(state_key(journey.id)) is not None or journey.kalman_estimator_state is not None
+
+    cache.delete(state_key(journey.id))
+    journey.kalman_estimator_state = None
+
+    if had_state:
+        models.Journey.objects.filter(id=journey.id).update(kalman_estimator_state=None)
@@ -0,0 +1,200 @@
+import datetime
+import json
+import time
+import numpy
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import override_settings
+import tracking.estimator
+import tracking.models
+import tracking.telemetry
+
+REPLAY_CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "estimator-replay",
+    }
+}
+PERCENTILES = (50, 90, 99)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Replays recorded vehicle positions through the arrival estimator and reports its speed and accuracy"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "traces",
+            help="JSON file mapping vehicle IDs to lists of positions; each with timestamp, lat, long and velocity"
+        )
+        parser.add_argument(
+            "--fixture", action="append", default=[],
+            help="Load this fixture into a fresh test database and replay against that instead of the configured "
+                 "database; can be given more than once"
+        )
+        parser.add_argument(
+            "--max-report-p90-ms", type=float, default=None,
+            help="Fail if the 90th percentile time to process a report is over this"
+        )
+
+    def handle(self, *args, **options):
+        with open(options["traces"], "r") as f:
+            traces = json.load(f)
+
+        positions = sorted(
+            ((p["timestamp"], vehicle_id, p) for vehicle_id, vehicle_positions in traces.items()
+             for p in vehicle_positions),
+            key=lambda p: p[0]
+        )
+        if not positions:
+            raise CommandError("No positions to replay")
+
+        # Nothing the replay does should reach the shared cache or outlive it in the database
+        with override_settings(CACHES=REPLAY_CACHES, TRACKING_SHARED_PATH_CACHE=False):
+            if options["fixture"]:
+                old_name = connection.settings_dict["NAME"]
+                connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+                try:
+                    call_command("loaddata", *options["fixture"], verbosity=0)
+                    results = self.replay(list(traces.keys()), positions)
+                finally:
+                    connection.creation.destroy_test_db(old_name, verbosity=0)
+            else:
+                try:
+                    with transaction.atomic():
+                        results = self.replay(list(traces.keys()), positions)
+                        raise Rollback()
+                except Rollback:
+                    pass
+
+        self.print_results(results)
+
+        if options["max_report_p90_ms"] is not None:
+            report_p90 = numpy.percentile(results["stages"]["report"], 90) * 1000
+            if report_p90 > options["max_report_p90_ms"]:
+                raise CommandError(
+                    f"Report p90 of {report_p90:.1f}ms is over the limit of {options['max_report_p90_ms']:.1f}ms"
+                )
+
+    def replay(self, vehicle_ids, positions) -> dict:
+        vehicles = tracking.models.Vehicle.objects.in_bulk(vehicle_ids)
+        if missing := set(vehicle_ids) - set(str(v) for v in vehicles.keys()):
+            raise CommandError(f"Unknown vehicles: {', '.join(sorted(missing))}")
+
+        journey_points = tracking.models.JourneyPoint.objects.filter(journey__vehicle__in=vehicle_ids)
+        recorded_arrivals = dict(journey_points.filter(
+            real_time_arrival__isnull=False
+        ).values_list("id", "real_time_arrival"))
+
+        # Start the day again as it was planned
+        journey_points.update(
+            real_time_arrival=None, real_time_departure=None, estimated_arrival=None, estimated_departure=None
+        )
+        tracking.models.Journey.objects.filter(vehicle__in=vehicle_ids).update(
+            real_time_state=tracking.models.Journey.RT_STATE_PLANNED, kalman_estimator_state=None
+        )
+        tracking.models.VehiclePosition.objects.filter(
+            vehicle__in=vehicle_ids, timestamp__gte=datetime.datetime.fromtimestamp(
+                positions[0][0], tz=datetime.timezone.utc
+            )
+        ).delete()
+
+        stages = {}
+        queries = {}
+        predictions = []
+        reports = 0
+        busy_seconds = 0.0
+
+        def record(trace: tracking.telemetry.Trace):
+            for stage, seconds in trace.durations.items():
+                stages.setdefault(stage, []).append(seconds)
+                queries.setdefault(stage, []).append(trace.queries.get(stage, 0))
+
+        next_sweep = positions[0][0] + tracking.estimator.ESTIMATE_SWEEP_INTERVAL
+        for timestamp, vehicle_id, position in positions:
+            while next_sweep <= timestamp:
+                now = datetime.datetime.fromtimestamp(next_sweep, tz=datetime.timezone.utc)
+                start = time.perf_counter()
+                with tracking.telemetry.trace("sweep") as trace:
+                    tracking.estimator.update_journeys_from_estimates(list(tracking.models.Journey.objects.filter(
+                        real_time_state=tracking.models.Journey.RT_STATE_ACTIVE
+                    ).select_related("vehicle", "shape")), now)
+                busy_seconds += time.perf_counter() - start
+                record(trace)
+                next_sweep += tracking.estimator.ESTIMATE_SWEEP_INTERVAL
+
+            now = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+            tracking.models.VehiclePosition.objects.create(
+                vehicle_id=vehicle_id,
+                timestamp=now,
+                latitude=position["lat"],
+                longitude=position["long"],
+                velocity_ms=position.get("velocity"),
+            )
+
+            start = time.perf_counter()
+            with tracking.telemetry.trace("report", vehicle=vehicle_id) as trace:
+                tracking.estimator.process_vehicle_report(vehicle_id)
+            busy_seconds += time.perf_counter() - start
+            record(trace)
+            reports += 1
+
+            predictions.extend(
+                (point_id, now, estimated_arrival) for point_id, estimated_arrival in journey_points.filter(
+                    real_time_arrival__isnull=True, estimated_arrival__isnull=False
+                ).values_list("id", "estimated_arrival")
+            )
+
+        # Without recorded arrivals, judge against the arrivals the replay itself detected
+        actual_arrivals = recorded_arrivals or dict(journey_points.filter(
+            real_time_arrival__isnull=False
+        ).values_list("id", "real_time_arrival"))
+        eta_errors = [
+            (estimated_arrival - actual_arrivals[point_id]).total_seconds()
+            for point_id, now, estimated_arrival in predictions
+            if point_id in actual_arrivals and now < actual_arrivals[point_id]
+        ]
+
+        return {
+            "reports": reports,
+            "busy_seconds": busy_seconds,
+            "stages": stages,
+            "queries": queries,
+            "eta_errors": eta_errors,
+            "recorded_arrivals": bool(recorded_arrivals),
+        }
+
+    def print_results(self, results: dict):
+        self.stdout.write(
+            f"{results['reports']} reports in {results['busy_seconds']:.2f}s of estimator time - "
+            f"{results['reports'] / max(results['busy_seconds'], 1e-9):.1f} reports/s"
+        )
+
+        self.stdout.write("")
+        self.stdout.write(f"{'stage':<24}{'calls':>8}" + "".join(f"{f'p{p} ms':>12}" for p in PERCENTILES) +
+                          f"{'queries':>10}")
+        for stage in tracking.telemetry.STAGES:
+            if stage not in results["stages"]:
+                continue
+
+            samples = numpy.array(results["stages"][stage]) * 1000
+            self.stdout.write(
+                f"{stage:<24}{len(samples):>8}" +
+                "".join(f"{numpy.percentile(samples, p):>12.2f}" for p in PERCENTILES) +
+                f"{numpy.mean(results['queries'][stage]):>10.1f}"
+            )
+
+        self.stdout.write("")
+        errors = numpy.abs(numpy.array(results["eta_errors"]))
+        against = "recorded arrivals" if results["recorded_arrivals"] else "replayed arrivals"
+        if len(errors):
+            self.stdout.write(
+                f"ETA error against {against} over {len(errors)} predictions: mean {numpy.mean(errors):.1f}s, "
+                f"p50 {numpy.percentile(errors, 50):.1f}s, p90 {numpy.percentile(errors, 90):.1f}s"
+            )
+        else:
+            self.stdout.write(f"No predictions to compare against {against}")
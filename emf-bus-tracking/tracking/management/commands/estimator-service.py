@@ -0,0 +1,169 @@
+import asyncio
+import concurrent.futures
+import logging
+import time
+import typing
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, close_old_connections
+from django.utils import timezone
+import tracking.estimator
+import tracking.models
+import tracking.telemetry
+
+ESTIMATE_FLUSH_INTERVAL = 1.0
+LISTEN_RETRY_INTERVAL = 5.0
+
+
+class EstimatorService:
+    """Runs vehicle reports and the estimate sweep in one long lived process, so compiled paths, day plans and the
+    stop index stay in memory between reports. All database work happens on a single thread; that keeps each
+    vehicle's reports in order and gives the service one database connection."""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.db_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="estimator-db")
+        self.queue = asyncio.Queue()
+        self.pending = set()
+        self.listen_connection = None
+        self.listen_fd = None
+        self.next_sweep = time.monotonic() + tracking.estimator.ESTIMATE_SWEEP_INTERVAL
+        self.next_flush = time.monotonic() + ESTIMATE_FLUSH_INTERVAL
+
+    def listen(self):
+        self.listen_connection = connections.create_connection("default")
+        self.listen_connection.ensure_connection()
+        with self.listen_connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {tracking.estimator.ESTIMATOR_SERVICE_CHANNEL}")
+
+        self.listen_fd = self.listen_connection.connection.fileno()
+        self.loop.add_reader(self.listen_fd, self.receive_notifications)
+
+    async def relisten(self):
+        self.loop.remove_reader(self.listen_fd)
+        try:
+            self.listen_connection.close()
+        except Exception:
+            pass
+
+        while True:
+            try:
+                await self.run_db(self.listen)
+                break
+            except Exception:
+                logging.exception("Couldn't listen for vehicle reports, retrying")
+                await asyncio.sleep(LISTEN_RETRY_INTERVAL)
+
+        # Reports sent while the connection was down were lost, so catch up every vehicle that's running a journey
+        try:
+            for vehicle_id in await self.run_db(self.active_vehicle_ids):
+                self.enqueue(vehicle_id)
+        except Exception:
+            logging.exception("Couldn't find vehicles to catch up")
+
+    def receive_notifications(self):
+        raw_connection = self.listen_connection.connection
+        try:
+            raw_connection.poll()
+        except Exception:
+            logging.exception("Lost the connection listening for vehicle reports")
+            self.loop.create_task(self.relisten())
+            return
+
+        while raw_connection.notifies:
+            self.enqueue(raw_connection.notifies.pop(0).payload)
+
+    def enqueue(self, vehicle_id: str):
+        # Reports only ever read the latest position, so a vehicle already waiting doesn't need queueing again
+        if vehicle_id not in self.pending:
+            self.pending.add(vehicle_id)
+            self.queue.put_nowait(vehicle_id)
+
+    async def run_db(self, func, *args):
+        return await self.loop.run_in_executor(self.db_thread, self.with_connection, func, *args)
+
+    @staticmethod
+    def with_connection(func, *args):
+        # As Celery does around each task, so a dropped or expired connection is replaced rather than reused
+        close_old_connections()
+        return func(*args)
+
+    @staticmethod
+    def process_report(vehicle_id: str):
+        try:
+            with tracking.telemetry.trace("report", vehicle=vehicle_id):
+                tracking.estimator.process_vehicle_report(vehicle_id)
+        except tracking.models.Vehicle.DoesNotExist:
+            logging.warning(f"Report for unknown vehicle {vehicle_id}")
+        except Exception:
+            # Like a failed Celery task, one bad report mustn't stop the others
+            logging.exception(f"Estimator failed for report from vehicle {vehicle_id}")
+
+    @staticmethod
+    def sweep():
+        try:
+            with tracking.telemetry.trace("sweep"):
+                tracking.estimator.update_journeys_from_estimates(list(tracking.models.Journey.objects.filter(
+                    real_time_state=tracking.models.Journey.RT_STATE_ACTIVE
+                ).select_related("vehicle", "shape")), timezone.now())
+        except Exception:
+            logging.exception("Estimate sweep failed")
+
+    @staticmethod
+    def flush():
+        try:
+            tracking.estimator.flush_estimate_buffer()
+        except Exception:
+            logging.exception("Saving buffered estimates failed")
+
+    @staticmethod
+    def active_vehicle_ids() -> typing.List[str]:
+        return [str(vehicle_id) for vehicle_id in tracking.models.Journey.objects.filter(
+            real_time_state=tracking.models.Journey.RT_STATE_ACTIVE, vehicle__isnull=False
+        ).order_by().values_list("vehicle_id", flat=True).distinct()]
+
+    async def run(self):
+        await self.run_db(self.listen)
+
+        while True:
+            now = time.monotonic()
+            try:
+                vehicle_id = await asyncio.wait_for(
+                    self.queue.get(), timeout=max(min(self.next_sweep, self.next_flush) - now, 0)
+                )
+            except asyncio.TimeoutError:
+                vehicle_id = None
+
+            if vehicle_id:
+                self.pending.discard(vehicle_id)
+                await self.run_db(self.process_report, vehicle_id)
+
+            now = time.monotonic()
+            if now >= self.next_sweep:
+                self.next_sweep = now + tracking.estimator.ESTIMATE_SWEEP_INTERVAL
+                # A connection that's gone without the socket becoming readable only shows up when it's used
+                self.receive_notifications()
+                await self.run_db(self.sweep)
+
+            if now >= self.next_flush or self.queue.empty():
+                self.next_flush = now + ESTIMATE_FLUSH_INTERVAL
+                await self.run_db(self.flush)
+
+
+class Command(BaseCommand):
+    help = "Runs the arrival estimator as a long lived service, taking vehicle reports from database notifications"
+
+    def handle(self, *args, **options):
+        if not tracking.estimator.estimator_service_enabled():
+            raise CommandError("TRACKING_ESTIMATOR_SERVICE must be set so that reports are sent to the service")
+        if connections["default"].vendor != "postgresql":
+            raise CommandError("The estimator service needs PostgreSQL notifications")
+
+        tracking.estimator.estimate_buffer = {}
+        try:
+            asyncio.run(self.serve())
+        finally:
+            tracking.estimator.flush_estimate_buffer()
+
+    @staticmethod
+    async def serve():
+        await EstimatorService().run()
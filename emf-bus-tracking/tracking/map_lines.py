@@ -1,9 +1,13 @@
+import array
 import collections
+import numpy
 import shapely
 import typing
 import enum
-import scipy.spatial
 import heapq
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.spatial
 
 
 MAX_LEN = 0.0001
@@ -19,48 +23,94 @@ PathEdge = collections.namedtuple("PathEdge", ["source_point", "target_point", "
 LinePart = collections.namedtuple("LinePart", ["line", "direction", "data"])
 
 
-class GraphEdge:
-    def __init__(self, point: shapely.Point, length: float, direction: EdgeDirection, data: EdgeProperties):
-        self.point = point
-        self.direction = direction
-        self.length = length
-        self.data = data
+class GraphSearch:
+    """One direction of a Dijkstra search over CSR adjacency, only holding the nodes it has reached"""
+
+    def __init__(self, source: int, indptr: numpy.ndarray, indices: numpy.ndarray, weights: numpy.ndarray):
+        self.source = source
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.distances = {source: 0.0}
+        self.previous = {}
+        self.queue = [(0.0, source)]
 
+    def next_distance(self) -> float:
+        return self.queue[0][0] if self.queue else float("inf")
 
-class DijkstraNode:
-    def __init__(self, point: shapely.Point, current_distance: float):
-        self.point = point
-        self.distance = current_distance
+    def step(self) -> typing.List[typing.Tuple[int, float]]:
+        """Settles the nearest node in the queue, and returns the nodes that got closer from it"""
 
-    def __lt__(self, other):
-        return self.distance < other.distance
+        distance, node = heapq.heappop(self.queue)
+        if distance > self.distances[node]:
+            return []
 
-    def __eq__(self, other):
-        return self.distance == other.distance
+        improved = []
+        row = slice(self.indptr[node], self.indptr[node + 1])
+        for neighbour, weight in zip(self.indices[row].tolist(), self.weights[row].tolist()):
+            new_distance = distance + weight
+            if new_distance < self.distances.get(neighbour, float("inf")):
+                self.distances[neighbour] = new_distance
+                self.previous[neighbour] = node
+                heapq.heappush(self.queue, (new_distance, neighbour))
+                improved.append((neighbour, new_distance))
 
-    def __gt__(self, other):
-        return self.distance > other.distance
+        return improved
+
+    def path_to(self, node: int) -> typing.List[int]:
+        """Nodes from the given one back to where the search started"""
+
+        path = [node]
+        while path[-1] != self.source:
+            path.append(self.previous[path[-1]])
+        return path
 
 
 class Graph:
-    nodes: typing.Set[shapely.Point]
-    edges: typing.Dict[shapely.Point, typing.List[GraphEdge]]
+    """A road graph with integer node IDs. Edges are collected as they're added and compiled into CSR adjacency,
+    sorted by source and target node, the first time the graph is searched. Where several edges join the same pair
+    of nodes in the same direction only the cheapest is kept."""
+
+    node_ids: typing.Dict[typing.Tuple[float, float], int]
+    edge_properties: typing.List[EdgeProperties]
+    # Compiled on first use
+    coords: numpy.ndarray
+    indptr: numpy.ndarray
+    indices: numpy.ndarray
+    weights: numpy.ndarray
+    directions: numpy.ndarray
+    property_ids: numpy.ndarray
+    # The same edges by target node, for searching backwards from the end of a path
+    reverse_indptr: numpy.ndarray
+    reverse_indices: numpy.ndarray
+    reverse_weights: numpy.ndarray
 
     def __init__(self):
-        self.nodes = set()
-        self.edges = {}
+        self.node_ids = {}
+        self.node_coords = array.array("d")
+        self.edge_properties = []
+        self.edge_sources = array.array("q")
+        self.edge_targets = array.array("q")
+        self.edge_weights = array.array("d")
+        self.edge_directions = array.array("b")
+        self.edge_property_ids = array.array("q")
+        self.compiled = False
 
     def __len__(self):
-        return len(self.nodes)
+        return len(self.node_ids)
 
     def get_nodes(self) -> typing.List[shapely.Point]:
-        return list(self.nodes)
+        return list(shapely.points(self.node_coords_array()))
 
-    def add_point(self, point: shapely.Point):
-        if point in self.nodes:
-            return
+    def node_coords_array(self) -> numpy.ndarray:
+        return numpy.frombuffer(self.node_coords, dtype=numpy.float64).reshape(-1, 2)
 
-        self.nodes.add(point)
+    def add_point(self, point: shapely.Point) -> int:
+        key = (point.x, point.y)
+        if (node_id := self.node_ids.get(key)) is None:
+            node_id = self.node_ids[key] = len(self.node_ids)
+            self.node_coords.extend(key)
+        return node_id
 
     def add_edge(
             self,
@@ -70,119 +120,146 @@ class Graph:
             forward_direction: bool = True,
             backward_direction: bool = True
     ):
-        self.add_point(a)
-        self.add_point(b)
-
-        if a not in self.edges:
-            self.edges[a] = []
-        if b not in self.edges:
-            self.edges[b] = []
+        a_id = self.add_point(a)
+        b_id = self.add_point(b)
+        property_id = len(self.edge_properties)
+        self.edge_properties.append(data)
 
         if forward_direction:
-            self.edges[a].append(GraphEdge(
-                b, length, EdgeDirection.FORWARD, data
-            ))
+            self._append_edge(a_id, b_id, length, EdgeDirection.FORWARD, property_id)
         if backward_direction:
-            self.edges[b].append(GraphEdge(
-                a, length, EdgeDirection.BACKWARD, data
-            ))
+            self._append_edge(b_id, a_id, length, EdgeDirection.BACKWARD, property_id)
+
+    def _append_edge(self, source: int, target: int, length: float, direction: EdgeDirection, property_id: int):
+        self.edge_sources.append(source)
+        self.edge_targets.append(target)
+        self.edge_weights.append(length)
+        self.edge_directions.append(direction.value)
+        self.edge_property_ids.append(property_id)
+        self.compiled = False
+
+    def compile(self):
+        if self.compiled:
+            return
 
-    def _dijkstra(self, start_node: shapely.Point):
-        distances = {node: float('infinity') for node in self.get_nodes()}
-        distances[start_node] = 0
-        previous_nodes = {}
+        sources = numpy.frombuffer(self.edge_sources, dtype=numpy.int64)
+        targets = numpy.frombuffer(self.edge_targets, dtype=numpy.int64)
+        weights = numpy.frombuffer(self.edge_weights, dtype=numpy.float64)
 
-        pq = [DijkstraNode(start_node, 0.0)]
-        while len(pq) > 0:
-            current_node = heapq.heappop(pq)
+        order = numpy.lexsort((weights, targets, sources))
+        sources, targets = sources[order], targets[order]
+        keep = numpy.ones(len(order), dtype=bool)
+        keep[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+        order = order[keep]
 
-            if current_node.distance > distances[current_node.point]:
-                continue
+        self.coords = self.node_coords_array().copy()
+        self.indices = targets[keep]
+        self.weights = weights[order]
+        self.directions = numpy.frombuffer(self.edge_directions, dtype=numpy.int8)[order]
+        self.property_ids = numpy.frombuffer(self.edge_property_ids, dtype=numpy.int64)[order]
+        self.indptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(sources[keep], minlength=len(self)))))
 
-            edges = self.edges[current_node.point]
-            for edge in edges:
-                new_distance = current_node.distance + edge.length
+        by_target = numpy.argsort(self.indices, kind="stable")
+        self.reverse_indices = sources[keep][by_target]
+        self.reverse_weights = self.weights[by_target]
+        self.reverse_indptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(self.indices, minlength=len(self)))))
+        self.compiled = True
 
-                if new_distance < distances[edge.point]:
-                    distances[edge.point] = new_distance
-                    previous_nodes[edge.point] = (current_node.point, edge.data, edge.direction)
-                    heapq.heappush(pq, DijkstraNode(edge.point, new_distance))
+    def csr(self) -> scipy.sparse.csr_array:
+        self.compile()
+        return scipy.sparse.csr_array((self.weights, self.indices, self.indptr), shape=(len(self), len(self)))
 
-        return previous_nodes
+    def node_id(self, point: shapely.Point) -> int:
+        return self.node_ids[(point.x, point.y)]
 
-    @staticmethod
-    def _dijkstra_path(
-            previous_nodes: typing.Dict[shapely.points, typing.Tuple[shapely.Point, EdgeProperties, EdgeDirection]],
-            start_node: shapely.Point, end_node: shapely.Point
-    ):
-        if end_node not in previous_nodes:
-            return None
+    def node_point(self, node_id: int) -> shapely.Point:
+        return shapely.Point(self.coords[node_id])
 
-        path = []
-        node, edge, direction = previous_nodes[end_node]
-        path.append(PathEdge(
-            source_point=node, target_point=end_node,
-            data=edge, direction=direction
-        ))
+    def edge_index(self, source: int, target: int) -> int:
+        row_start = self.indptr[source]
+        return int(row_start + numpy.searchsorted(self.indices[row_start:self.indptr[source + 1]], target))
 
-        while node != start_node:
-            if node not in previous_nodes:
-                return None
-            prev_node = node
-            node, edge, direction = previous_nodes[node]
+    def _path_edges(self, node_path: typing.List[int]) -> typing.List[PathEdge]:
+        path = []
+        for source, target in zip(node_path, node_path[1:]):
+            edge = self.edge_index(source, target)
             path.append(PathEdge(
-                source_point=node, target_point=prev_node,
-                data=edge, direction=direction
+                source_point=self.node_point(source), target_point=self.node_point(target),
+                data=self.edge_properties[self.property_ids[edge]],
+                direction=EdgeDirection(int(self.directions[edge]))
             ))
+        return path
+
+    def shortest_path(
+            self, start_node: shapely.Point, end_node: shapely.Point
+    ) -> typing.Optional[typing.List[PathEdge]]:
+        """Bidirectional Dijkstra, searching forwards from the start and backwards from the end at once and stopping
+        as soon as no shorter path can remain. Edge weights are how far the road is from the path being matched, so
+        the searches stay in the corridor around it rather than covering the whole graph."""
+
+        start, end = self.node_id(start_node), self.node_id(end_node)
+        if start == end:
+            return None
+
+        self.compile()
+        forward = GraphSearch(start, self.indptr, self.indices, self.weights)
+        backward = GraphSearch(end, self.reverse_indptr, self.reverse_indices, self.reverse_weights)
+
+        best_distance = float("inf")
+        meeting_node = None
+        while forward.next_distance() + backward.next_distance() < best_distance:
+            search, other = (forward, backward) if forward.next_distance() <= backward.next_distance() \
+                else (backward, forward)
+            for node, distance in search.step():
+                if node in other.distances and distance + other.distances[node] < best_distance:
+                    best_distance = distance + other.distances[node]
+                    meeting_node = node
+
+        if meeting_node is None:
+            return None
+
+        return self._path_edges(forward.path_to(meeting_node)[::-1] + backward.path_to(meeting_node)[1:])
+
+    def subgraph(self, node_ids: numpy.ndarray) -> "Graph":
+        """The graph of just the given nodes and the edges between them"""
+
+        self.compile()
+        new_ids = numpy.full(len(self), -1, dtype=numpy.int64)
+        new_ids[node_ids] = numpy.arange(len(node_ids))
 
-        return path[::-1]
+        graph = Graph()
+        graph.node_coords = array.array("d", self.coords[node_ids].ravel())
+        graph.node_ids = {(float(x), float(y)): i for i, (x, y) in enumerate(self.coords[node_ids])}
+        graph.edge_properties = self.edge_properties
 
-    def shortest_path(self, start_node: shapely.Point, end_node: shapely.Point) -> typing.List[PathEdge]:
-        previous_nodes = self._dijkstra(start_node)
-        return self._dijkstra_path(previous_nodes, start_node, end_node)
+        sources = numpy.repeat(numpy.arange(len(self)), numpy.diff(self.indptr))
+        kept = (new_ids[sources] >= 0) & (new_ids[self.indices] >= 0)
+        graph.edge_sources = array.array("q", new_ids[sources[kept]])
+        graph.edge_targets = array.array("q", new_ids[self.indices[kept]])
+        graph.edge_weights = array.array("d", self.weights[kept])
+        graph.edge_directions = array.array("b", self.directions[kept])
+        graph.edge_property_ids = array.array("q", self.property_ids[kept])
+        return graph
 
     def connected_components(self) -> typing.List["Graph"]:
-        unvisited = set(self.nodes)
-        components = []
-
-        while unvisited:
-            component = []
-            stack = [list(unvisited)[0]]
-            while stack:
-                current_node = stack.pop()
-                if current_node not in unvisited:
-                    continue
-                unvisited.remove(current_node)
-                component.append((current_node, self.edges[current_node]))
-                for edge in self.edges[current_node]:
-                    stack.append(edge.point)
-
-            component_graph = Graph()
-            for node, edges in component:
-                component_graph.nodes.add(node)
-                component_graph.edges[node] = edges
-
-            components.append(component_graph)
-
-        return components
+        _, labels = scipy.sparse.csgraph.connected_components(self.csr(), directed=True, connection="weak")
+        return [self.subgraph(numpy.flatnonzero(labels == label)) for label in numpy.unique(labels)]
 
     def largest_connected_component(self) -> "Graph":
-        components = self.connected_components()
-        return max(components, key=len)
+        _, labels = scipy.sparse.csgraph.connected_components(self.csr(), directed=True, connection="weak")
+        return self.subgraph(numpy.flatnonzero(labels == numpy.argmax(numpy.bincount(labels))))
 
 
 def search_start_end_points(graph: Graph, search_path: shapely.LineString):
     path_start = search_path.coords[0]
     path_end = search_path.coords[-1]
 
-    graph_nodes = graph.get_nodes()
-    graph_kd_tree = scipy.spatial.KDTree([(p.x, p.y) for p in graph_nodes])
+    graph.compile()
+    graph_kd_tree = scipy.spatial.KDTree(graph.coords)
     graph_start_idx = graph_kd_tree.query((path_start[0], path_start[1]))[1]
     graph_end_idx = graph_kd_tree.query((path_end[0], path_end[1]))[1]
-    graph_start = graph_nodes[graph_start_idx]
-    graph_end = graph_nodes[graph_end_idx]
 
-    return graph_start, graph_end
+    return graph.node_point(graph_start_idx), graph.node_point(graph_end_idx)
 
 
 def find_matching_graph_path(graph: Graph, search_path: shapely.LineString) -> typing.List[PathEdge]:
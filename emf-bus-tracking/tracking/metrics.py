@@ -1,12 +1,36 @@
 import prometheus_client
+import prometheus_client.core
+from django.core.cache import cache
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from . import models
+from . import models, estimator, telemetry
+
+
+class EstimatorStageCollector(prometheus_client.registry.Collector):
+    """Stage timings recorded by every worker process, read back from the shared cache"""
+
+    def collect(self):
+        latency = prometheus_client.core.HistogramMetricFamily(
+            'tfemf_estimator_stage_seconds', 'Time spent in each stage of the arrival estimator',
+            labels=['stage']
+        )
+        queries = prometheus_client.core.CounterMetricFamily(
+            'tfemf_estimator_stage_queries', 'Database queries made in each stage of the arrival estimator',
+            labels=['stage']
+        )
+
+        for stage, histogram in telemetry.stage_histograms().items():
+            latency.add_metric([stage], histogram["buckets"], histogram["sum"])
+            queries.add_metric([stage], histogram["queries"])
+
+        yield latency
+        yield queries
 
 
 @csrf_exempt
 def metrics(_request):
     registry = prometheus_client.CollectorRegistry()
+    registry.register(EstimatorStageCollector())
     vehicle_speed = prometheus_client.Gauge(
         'tfemf_vehicle_speed_ms', 'The last known speed of a vehicle',
         labelnames=['vehicle'],
@@ -32,6 +56,25 @@ def metrics(_request):
         labelnames=['vehicle'],
         registry=registry
     )
+    reports_coalesced = prometheus_client.Counter(
+        'tfemf_vehicle_reports_coalesced', 'Vehicle position reports folded into an already pending estimator run',
+        registry=registry
+    )
+    reports_coalesced.inc(cache.get(estimator.REPORTS_COALESCED_KEY) or 0)
+    estimate_writes_suppressed = prometheus_client.Counter(
+        'tfemf_estimate_writes_suppressed', 'Journey point estimate writes skipped as the estimate barely changed',
+        registry=registry
+    )
+    estimate_writes_suppressed.inc(cache.get(estimator.ESTIMATE_WRITES_SUPPRESSED_KEY) or 0)
+    reports_idle = prometheus_client.Counter(
+        'tfemf_vehicle_reports_idle', 'Vehicle position reports acknowledged without running the estimator, as the '
+                                      'vehicle was parked up with no journey due',
+        labelnames=['reason'],
+        registry=registry
+    )
+    idle_counts = cache.get_many([estimator.reports_idle_key(reason) for reason in estimator.IDLE_REASONS])
+    for reason in estimator.IDLE_REASONS:
+        reports_idle.labels(reason=reason).inc(idle_counts.get(estimator.reports_idle_key(reason)) or 0)
 
     for vehicle in models.Vehicle.objects.all():
         last_position = vehicle.positions.order_by("-timestamp").first()
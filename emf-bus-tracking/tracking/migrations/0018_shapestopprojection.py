@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:09
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tracking", "0017_stop_internal_name_alter_stop_code_alter_stop_name"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ShapeStopProjection",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        unique=True,
+                    ),
+                ),
+                (
+                    "direction",
+                    models.PositiveSmallIntegerField(
+                        choices=[(0, "Forward"), (1, "Reverse")], default=0
+                    ),
+                ),
+                ("segment_index", models.PositiveIntegerField()),
+                ("fraction", models.FloatField()),
+                (
+                    "distance_along",
+                    models.FloatField(verbose_name="Distance along shape (m)"),
+                ),
+                (
+                    "shape",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="stop_projections",
+                        to="tracking.shape",
+                    ),
+                ),
+                (
+                    "stop",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="shape_projections",
+                        to="tracking.stop",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("shape", "stop", "direction")},
+            },
+        ),
+    ]
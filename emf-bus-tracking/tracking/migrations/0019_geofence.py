@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:30
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tracking", "0018_shapestopprojection"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Geofence",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                        unique=True,
+                    ),
+                ),
+                ("name", models.CharField(max_length=255)),
+                (
+                    "kind",
+                    models.PositiveSmallIntegerField(
+                        choices=[(0, "Depot"), (1, "Layover")], default=0
+                    ),
+                ),
+                ("latitude", models.FloatField()),
+                ("longitude", models.FloatField()),
+                ("radius_meters", models.FloatField(verbose_name="Radius (m)")),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tracking", "0019_geofence"),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name="shapestopprojection",
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name="shapestopprojection",
+            name="generation",
+            field=models.CharField(blank=True, default="", max_length=32),
+        ),
+        migrations.AlterUniqueTogether(
+            name="shapestopprojection",
+            unique_together={("shape", "stop", "direction", "generation")},
+        ),
+    ]
@@ -6,7 +6,7 @@ from gtfs.gtfs_rt import gtfs_realtime_pb2
 import uuid
 import datetime
 import typing
-from . import consts
+from . import consts, path_cache
 
 
 class Stop(models.Model):
@@ -26,6 +26,25 @@ class Stop(models.Model):
 
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_coordinates = (instance.__dict__.get("latitude"), instance.__dict__.get("longitude"))
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        if getattr(self, "_loaded_coordinates", None) != (self.latitude, self.longitude):
+            self.shape_projections.all().delete()
+            self._loaded_coordinates = (self.latitude, self.longitude)
+            path_cache.invalidate_stops()
+
+    def delete(self, *args, **kwargs):
+        path_cache.invalidate_stops()
+
+        return super().delete(*args, **kwargs)
+
 
 class Route(models.Model):
     TYPE_TRAM = 0
@@ -151,6 +170,27 @@ class Journey(models.Model):
     class Meta:
         ordering = ['code']
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_plan = instance.plan_fields()
+        return instance
+
+    def plan_fields(self):
+        return self.__dict__.get("vehicle_id"), self.__dict__.get("forms_from_id")
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        if getattr(self, "_loaded_plan", None) != self.plan_fields():
+            path_cache.invalidate_day_plans()
+            self._loaded_plan = self.plan_fields()
+
+    def delete(self, *args, **kwargs):
+        path_cache.invalidate_day_plans()
+
+        return super().delete(*args, **kwargs)
+
     def forms_into_opt(self) -> typing.Optional["Journey"]:
         try:
             return self.forms_into
@@ -201,6 +241,34 @@ class JourneyPoint(models.Model):
     class Meta:
         ordering = ['order']
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_plan = instance.plan_fields()
+        instance._loaded_estimates = instance.estimate_fields()
+        return instance
+
+    def plan_fields(self):
+        return tuple(self.__dict__.get(f) for f in ("journey_id", "stop_id", "order", "arrival_time", "departure_time"))
+
+    def estimate_fields(self):
+        return self.__dict__.get("estimated_arrival"), self.__dict__.get("estimated_departure")
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        self._loaded_estimates = self.estimate_fields()
+
+        # Real-time fields change on every report; only schedule changes affect day plans
+        if getattr(self, "_loaded_plan", None) != self.plan_fields():
+            path_cache.invalidate_day_plans()
+            self._loaded_plan = self.plan_fields()
+
+    def delete(self, *args, **kwargs):
+        path_cache.invalidate_day_plans()
+
+        return super().delete(*args, **kwargs)
+
     def validate_constraints(self, exclude=None):
         if not self.arrival_time and not self.departure_time:
             raise ValidationError("Arrival time or departure time must be set")
@@ -214,6 +282,17 @@ class Shape(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        path_cache.invalidate_shape(self.id)
+        self.stop_projections.all().delete()
+
+    def delete(self, *args, **kwargs):
+        path_cache.invalidate_shape(self.id)
+
+        return super().delete(*args, **kwargs)
+
 
 class ShapePoint(models.Model):
     id = models.UUIDField(primary_key=True, editable=False, unique=True, default=uuid.uuid4)
@@ -226,6 +305,22 @@ class ShapePoint(models.Model):
     class Meta:
         ordering = ['order']
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        self.shape_changed()
+
+    def delete(self, *args, **kwargs):
+        self.shape_changed()
+
+        return super().delete(*args, **kwargs)
+
+    def shape_changed(self):
+        # Imports and speed updates save every point of a shape in one transaction, the first one clears it for all
+        if not path_cache.shape_invalidation_pending(self.shape_id):
+            path_cache.invalidate_shape(self.shape_id)
+            ShapeStopProjection.objects.filter(shape_id=self.shape_id).delete()
+
 
 class ShapePointAverageSpeed(models.Model):
     DIRECTION_FORWARD = 0
@@ -251,6 +346,59 @@ class ShapePointAverageSpeed(models.Model):
     direction = models.PositiveSmallIntegerField(choices=DIRECTIONS, default=DIRECTION_FORWARD)
 
 
+class ShapeStopProjection(models.Model):
+    DIRECTION_FORWARD = 0
+    DIRECTION_REVERSE = 1
+
+    DIRECTIONS = (
+        (DIRECTION_FORWARD, "Forward"),
+        (DIRECTION_REVERSE, "Reverse"),
+    )
+
+    id = models.UUIDField(primary_key=True, editable=False, unique=True, default=uuid.uuid4)
+    shape = models.ForeignKey(Shape, on_delete=models.CASCADE, related_name="stop_projections")
+    stop = models.ForeignKey(Stop, on_delete=models.CASCADE, related_name="shape_projections")
+    direction = models.PositiveSmallIntegerField(choices=DIRECTIONS, default=DIRECTION_FORWARD)
+    segment_index = models.PositiveIntegerField()
+    fraction = models.FloatField()
+    distance_along = models.FloatField(verbose_name="Distance along shape (m)")
+    # The shape's path cache generation the projection was made from; rows from older geometry are ignored
+    generation = models.CharField(max_length=32, blank=True, default="")
+
+    class Meta:
+        unique_together = [("shape", "stop", "direction", "generation")]
+
+
+class Geofence(models.Model):
+    KIND_DEPOT = 0
+    KIND_LAYOVER = 1
+
+    KINDS = (
+        (KIND_DEPOT, "Depot"),
+        (KIND_LAYOVER, "Layover"),
+    )
+
+    id = models.UUIDField(primary_key=True, editable=False, unique=True, default=uuid.uuid4)
+    name = models.CharField(max_length=255)
+    kind = models.PositiveSmallIntegerField(choices=KINDS, default=KIND_DEPOT)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    radius_meters = models.FloatField(verbose_name="Radius (m)")
+
+    def __str__(self):
+        return self.name
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        path_cache.invalidate_geofences()
+
+    def delete(self, *args, **kwargs):
+        path_cache.invalidate_geofences()
+
+        return super().delete(*args, **kwargs)
+
+
 class ServiceAlert(models.Model):
     CAUSES = (
         (gtfs_realtime_pb2.Alert.Cause.OTHER_CAUSE, "Other cause"),
@@ -98,13 +98,16 @@ def os_features_to_graph(os_data: typing.List[dict], search_path: shapely.LineSt
         in_direction = all(feature["properties"][k] for k in in_direction_speeds)
         out_direction = all(feature["properties"][k] for k in out_direction_speeds)
 
+        points = shapely.points(line.coords)
+        # Distance of every vertex from the search path, in one call for the whole feature
+        path_distances = shapely.distance(points, search_path)
+
         last_point = None
-        for point in line.coords:
-            point = shapely.geometry.Point(point)
+        for point, path_distance in zip(points, path_distances):
             if last_point:
                 graph.add_edge(
                     a=last_point, b=point,
-                    length=float(point.distance(search_path)),
+                    length=float(path_distance),
                     data=map_lines.EdgeProperties(
                         id=feature["id"],
                         data=feature["properties"]
@@ -0,0 +1,154 @@
+import collections
+import threading
+import typing
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+PATH_CACHE_SIZE = 32
+SHARED_PATH_CACHE_TIMEOUT = 60 * 60 * 24
+# Memcached refuses items over 1MB, leave some room for the key and pickle overhead
+SHARED_PATH_CACHE_MAX_BYTES = 1000 * 1000
+
+
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key) -> typing.Optional[typing.Any]:
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+local_paths = LRUCache(PATH_CACHE_SIZE)
+
+
+def shared_cache_enabled() -> bool:
+    return getattr(settings, "TRACKING_SHARED_PATH_CACHE", True)
+
+
+STOPS_GENERATION_KEY = "tracking_stops_generation"
+DAY_PLANS_GENERATION_KEY = "tracking_day_plans_generation"
+GEOFENCES_GENERATION_KEY = "tracking_geofences_generation"
+
+
+def generation_key(shape_id) -> str:
+    return f"tracking_shape_generation:{shape_id}"
+
+
+def generation(key: str) -> str:
+    """Returns a token that changes every time the data it covers is modified. If the token has been evicted a new
+    one is created, so anything cached under an older token can never be served."""
+
+    if token := cache.get(key):
+        return token
+
+    cache.add(key, uuid.uuid4().hex, None)
+    return cache.get(key)
+
+
+class Invalidation:
+    def __init__(self, key: str):
+        self.key = key
+
+    def __call__(self):
+        cache.set(self.key, uuid.uuid4().hex, None)
+
+
+def invalidation_pending(key: str) -> bool:
+    """Whether the current transaction will already invalidate key when it commits. Django drops the callbacks of
+    rolled back savepoints, so an invalidation that won't happen is never reported."""
+
+    connection = transaction.get_connection()
+    return connection.in_atomic_block and any(
+        isinstance(func, Invalidation) and func.key == key for _, func, _ in connection.run_on_commit
+    )
+
+
+def invalidate(key: str):
+    # Bulk edits save thousands of rows in one transaction, one new token on commit covers them all
+    if not invalidation_pending(key):
+        transaction.on_commit(Invalidation(key))
+
+
+def shape_generation(shape_id) -> str:
+    return generation(generation_key(shape_id))
+
+
+def invalidate_shape(shape_id):
+    invalidate(generation_key(shape_id))
+
+
+def shape_invalidation_pending(shape_id) -> bool:
+    return invalidation_pending(generation_key(shape_id))
+
+
+def stops_generation() -> str:
+    return generation(STOPS_GENERATION_KEY)
+
+
+def invalidate_stops():
+    invalidate(STOPS_GENERATION_KEY)
+
+
+def day_plans_generation() -> str:
+    return generation(DAY_PLANS_GENERATION_KEY)
+
+
+def invalidate_day_plans():
+    invalidate(DAY_PLANS_GENERATION_KEY)
+
+
+def geofences_generation() -> str:
+    return generation(GEOFENCES_GENERATION_KEY)
+
+
+def invalidate_geofences():
+    invalidate(GEOFENCES_GENERATION_KEY)
+
+
+def path_key(shape_id, reverse: bool, last_update, generation: str) -> str:
+    last_update = int(last_update.timestamp()) if last_update else "none"
+    return f"tracking_path:{shape_id}:{int(reverse)}:{last_update}:{generation}"
+
+
+def get_local(key: str) -> typing.Optional[typing.Any]:
+    return local_paths.get(key)
+
+
+def put_local(key: str, value: typing.Any):
+    local_paths.put(key, value)
+
+
+def get_shared(key: str) -> typing.Optional[bytes]:
+    if not shared_cache_enabled():
+        return None
+
+    return cache.get(key)
+
+
+def put_shared(key: str, data: bytes):
+    if not shared_cache_enabled() or len(data) > SHARED_PATH_CACHE_MAX_BYTES:
+        return
+
+    cache.set(key, data, SHARED_PATH_CACHE_TIMEOUT)
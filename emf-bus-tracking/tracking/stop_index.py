@@ -0,0 +1,52 @@
+import threading
+import typing
+import uuid
+import scipy.spatial
+from . import models, path_cache, geodesy
+
+
+class StopIndex:
+    """All stops in a KD-tree over a local metric projection, for finding the stops near a position"""
+
+    def __init__(self, stops: typing.List[typing.Tuple[uuid.UUID, float, float]]):
+        self.stop_ids = [stop_id for stop_id, _, _ in stops]
+        latitudes = [lat for _, lat, _ in stops]
+        longitudes = [long for _, _, long in stops]
+
+        self.projection = geodesy.LocalProjection(
+            sum(latitudes) / len(stops) if stops else 0.0,
+            sum(longitudes) / len(stops) if stops else 0.0,
+        )
+        self.kd_tree = scipy.spatial.KDTree(self.projection.to_xy(latitudes, longitudes)) if stops else None
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    def within(self, lat: float, long: float, radius: float) -> typing.List[uuid.UUID]:
+        if self.kd_tree is None:
+            return []
+
+        return [self.stop_ids[i] for i in self.kd_tree.query_ball_point(self.projection.to_xy(lat, long), radius)]
+
+
+_index = None
+_index_generation = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> StopIndex:
+    """The stop index for this process, rebuilt whenever any stop has been added, moved or deleted"""
+
+    global _index, _index_generation
+
+    generation = path_cache.stops_generation()
+    with _index_lock:
+        if _index is None or _index_generation != generation:
+            _index = StopIndex(list(models.Stop.objects.values_list("id", "latitude", "longitude")))
+            _index_generation = generation
+
+        return _index
+
+
+def stops_near(lat: float, long: float, radius: float) -> typing.List[uuid.UUID]:
+    return get_index().within(lat, long, radius)
@@ -0,0 +1,160 @@
+import atexit
+import bisect
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import threading
+import time
+import typing
+from django.core.cache import cache
+from django.db import connection
+
+STAGES = (
+    "report", "sweep", "load_path", "find_current_journey", "find_point_on_path", "kalman", "future_stops",
+    "db_writes",
+)
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_TRACE_SECONDS = 1.0
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE")
+COUNTER_FLUSH_INTERVAL = 10.0
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+pending_counts = collections.Counter()
+pending_counts_lock = threading.Lock()
+last_counter_flush = time.monotonic()
+
+
+def increment(key: str, delta: int = 1):
+    """Adds to a counter shared by every worker process. Counts are gathered in the process and added to the shared
+    counter at most every COUNTER_FLUSH_INTERVAL, rather than costing a cache round trip each."""
+
+    with pending_counts_lock:
+        pending_counts[key] += delta
+    if time.monotonic() - last_counter_flush >= COUNTER_FLUSH_INTERVAL:
+        flush_counters()
+
+
+def flush_counters():
+    global last_counter_flush, pending_counts
+
+    with pending_counts_lock:
+        counts, pending_counts = pending_counts, collections.Counter()
+        last_counter_flush = time.monotonic()
+
+    for key, delta in counts.items():
+        if not delta:
+            continue
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # First count since the counter was created or evicted, unless another process got there first
+            if not cache.add(key, delta, None):
+                cache.incr(key, delta)
+
+
+atexit.register(flush_counters)
+
+
+def stage_key(stage: str, field: str) -> str:
+    return f"tracking_stage:{stage}:{field}"
+
+
+class Trace:
+    def __init__(self, name: str, context: dict):
+        self.name = name
+        self.context = context
+        self.durations = {}
+        self.queries = {}
+        self.active_stages = [name]
+
+    def add(self, stage: str, seconds: float, queries: int = 0):
+        self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+        self.queries[stage] = self.queries.get(stage, 0) + queries
+
+    def wrap_query(self, execute, sql, params, many, context):
+        for stage in self.active_stages:
+            self.queries[stage] = self.queries.get(stage, 0) + 1
+
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            if sql.lstrip().upper().startswith(WRITE_STATEMENTS):
+                self.add("db_writes", time.perf_counter() - start, 1)
+
+    def record(self):
+        for stage, seconds in self.durations.items():
+            increment(stage_key(stage, bisect.bisect_left(STAGE_BUCKETS, seconds)))
+            increment(stage_key(stage, "sum_us"), int(seconds * 1000000))
+            increment(stage_key(stage, "queries"), self.queries.get(stage, 0))
+
+        total = self.durations.get(self.name, 0.0)
+        if total > SLOW_TRACE_SECONDS:
+            logging.warning(f"Slow estimator {self.name}: " + json.dumps({
+                **self.context,
+                "seconds": round(total, 4),
+                "stages": {stage: round(seconds, 4) for stage, seconds in self.durations.items()},
+                "queries": self.queries,
+            }, default=str))
+
+
+@contextlib.contextmanager
+def trace(name: str, **context):
+    """Times one estimator run, along with any stages within it, and adds it to the shared histograms"""
+
+    current = Trace(name, context)
+    token = current_trace.set(current)
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(current.wrap_query):
+            yield current
+    finally:
+        current.add(name, time.perf_counter() - start)
+        current_trace.reset(token)
+        current.record()
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    current = current_trace.get()
+    if current is None:
+        yield
+        return
+
+    current.active_stages.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.active_stages.pop()
+        current.add(name, time.perf_counter() - start)
+
+
+def stage_histograms() -> typing.Dict[str, dict]:
+    """Histogram buckets (cumulative, as Prometheus wants them), sums and query counts for each stage"""
+
+    flush_counters()
+    keys = [stage_key(s, field) for s in STAGES for field in (*range(len(STAGE_BUCKETS) + 1), "sum_us", "queries")]
+    values = cache.get_many(keys)
+
+    histograms = {}
+    for s in STAGES:
+        counts = [values.get(stage_key(s, i), 0) for i in range(len(STAGE_BUCKETS) + 1)]
+        if not any(counts):
+            continue
+
+        cumulative = 0
+        buckets = []
+        for bound, count in zip((*(str(b) for b in STAGE_BUCKETS), "+Inf"), counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+
+        histograms[s] = {
+            "buckets": buckets,
+            "sum": values.get(stage_key(s, "sum_us"), 0) / 1000000,
+            "queries": values.get(stage_key(s, "queries"), 0),
+        }
+
+    return histograms
@@ -1,3 +1,1018 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import importlib
+import io
+import pathlib
+import time
+import typing
+import unittest.mock
+import geographiclib.geodesic
+import numpy
+import scipy.sparse.csgraph
+import shapely
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from . import (
+    consts, geodesy, kalman, models, estimator, path_cache, live_state, telemetry, stop_index, day_plan, map_lines
+)
 
-# Create your tests here.
+
+class GeodesyTestCase(SimpleTestCase):
+    # Spread of UK-scale lines; from a few metres along a street to across the country
+    LINES = [
+        (52.0392, -2.3780, 52.0392, -2.3780),
+        (52.0392, -2.3780, 52.03921, -2.37801),
+        (52.0392, -2.3780, 52.0401, -2.3765),
+        (52.0392, -2.3780, 52.1, -2.2),
+        (50.0657, -5.7132, 58.6373, -3.0689),
+        (51.5074, -0.1278, 53.4808, -2.2426),
+        (57.1497, -2.0943, 50.3755, -4.1427),
+        (54.0, -8.0, 54.0, 1.8),
+    ]
+    TOLERANCE_METERS = 0.001
+
+    def test_distances_match_geographiclib(self):
+        lines = numpy.array(self.LINES)
+        distances = geodesy.distances(lines[:, 0], lines[:, 1], lines[:, 2], lines[:, 3])
+
+        for (lat1, long1, lat2, long2), distance in zip(self.LINES, distances):
+            expected = geographiclib.geodesic.Geodesic.WGS84.Inverse(lat1, long1, lat2, long2)["s12"]
+            self.assertAlmostEqual(distance, expected, delta=self.TOLERANCE_METERS)
+
+    def test_segment_lengths(self):
+        lat = numpy.linspace(52.0, 52.1, 5000)
+        long = numpy.linspace(-2.4, -2.2, 5000)
+        lengths = geodesy.segment_lengths(lat, long)
+
+        self.assertEqual(len(lengths), 4999)
+        for i, length in enumerate(lengths):
+            expected = geographiclib.geodesic.Geodesic.WGS84.Inverse(lat[i], long[i], lat[i + 1], long[i + 1])["s12"]
+            self.assertAlmostEqual(length, expected, delta=self.TOLERANCE_METERS)
+
+
+class KalmanTestCase(SimpleTestCase):
+    def test_predict(self):
+        states = kalman.FilterStates.initial(100.0, 10.0, 0)
+        states = kalman.predict(states, 2)
+
+        # dt = 2, q = 0.1; P' = F P F' + Q with F = [[1, -dt], [0, 1]]
+        self.assertAlmostEqual(states.x[0], 80.0)
+        self.assertAlmostEqual(states.u[0], 10.0)
+        self.assertAlmostEqual(states.p_xx[0], 2.5 + 4 * 1.0 + 0.1 * 16 / 4)
+        self.assertAlmostEqual(states.p_xu[0], -2 * 1.0 - 0.1 * 8 / 2)
+        self.assertAlmostEqual(states.p_uu[0], 1.0 + 0.1 * 4)
+        self.assertEqual(states.t[0], 2)
+
+    def test_predict_holds_arrived_vehicle(self):
+        states = kalman.predict(kalman.FilterStates.initial(0.0, 10.0, 0), 30)
+
+        self.assertEqual(states.x[0], 0.0)
+        self.assertEqual(states.t[0], 0)
+
+    def test_update_distance(self):
+        states = kalman.FilterStates.from_dicts([{"x": 80.0, "u": 10.0, "p": [6.9, -2.4, 1.4], "t": 2}])
+        states = kalman.update_distance(states, numpy.array([78.0]))
+
+        # s = 6.9 + 2.5, innovation -2
+        self.assertAlmostEqual(states.x[0], 80.0 - 2 * 6.9 / 9.4)
+        self.assertAlmostEqual(states.u[0], 10.0 + 2 * 2.4 / 9.4)
+        self.assertAlmostEqual(states.p_xx[0], 2.5 * 6.9 / 9.4)
+        self.assertAlmostEqual(states.p_xu[0], 2.5 * -2.4 / 9.4)
+        self.assertAlmostEqual(states.p_uu[0], 1.4 - 2.4 * 2.4 / 9.4)
+
+    def test_update_velocity(self):
+        states = kalman.FilterStates.from_dicts([{"x": 80.0, "u": 10.0, "p": [6.9, -2.4, 1.4], "t": 2}])
+        states = kalman.update_velocity(states, numpy.array([12.0]))
+
+        # s = 1.4 + 1.0, innovation 2
+        self.assertAlmostEqual(states.x[0], 80.0 - 2 * 2.4 / 2.4)
+        self.assertAlmostEqual(states.u[0], 10.0 + 2 * 1.4 / 2.4)
+        self.assertAlmostEqual(states.p_xx[0], 6.9 - 2.4 * 2.4 / 2.4)
+        self.assertAlmostEqual(states.p_xu[0], 1.0 / 2.4 * -2.4)
+        self.assertAlmostEqual(states.p_uu[0], 1.0 / 2.4 * 1.4)
+
+    def test_dicts_round_trip(self):
+        states = [{"x": 80.0, "u": 10.0, "p": [6.9, -2.4, 1.4], "t": 2}]
+        self.assertEqual(kalman.FilterStates.from_dicts(states).to_dicts(), states)
+
+
+class EstimatorReplayTestCase(TestCase):
+    fixtures = ["estimator_replay"]
+    TRACE = pathlib.Path(__file__).parent / "fixtures" / "estimator_replay_trace.json"
+
+    def test_replay(self):
+        out = io.StringIO()
+        call_command("estimator-replay", str(self.TRACE), "--max-report-p90-ms", "10000", stdout=out)
+
+        self.assertIn("40 reports in", out.getvalue())
+        self.assertIn("ETA error against replayed arrivals", out.getvalue())
+        # The replay is rolled back
+        self.assertFalse(models.VehiclePosition.objects.exists())
+        self.assertFalse(models.JourneyPoint.objects.filter(real_time_arrival__isnull=False).exists())
+
+    def test_report_time_limit(self):
+        with self.assertRaisesMessage(CommandError, "is over the limit of 0.0ms"):
+            call_command("estimator-replay", str(self.TRACE), "--max-report-p90-ms", "0", stdout=io.StringIO())
+
+
+def create_shape(points: int = 50) -> models.Shape:
+    """A straight shape running north, about 55m between points"""
+
+    shape = models.Shape.objects.create(name="Test shape")
+    for i in range(points):
+        models.ShapePoint.objects.create(shape=shape, latitude=52.0 + i * 0.0005, longitude=-2.0, order=i)
+    return shape
+
+
+# Shape edits are invalidated when their transaction commits, which TestCase never does
+class PathCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        path_cache.local_paths.clear()
+
+    def test_generation_changes_on_commit(self):
+        key = f"tracking_test_generation:{self.id()}"
+        token = path_cache.generation(key)
+        self.assertEqual(path_cache.generation(key), token)
+
+        with transaction.atomic():
+            path_cache.invalidate(key)
+            self.assertEqual(path_cache.generation(key), token)
+
+        self.assertNotEqual(path_cache.generation(key), token)
+
+    def test_path_reused_until_shape_edited(self):
+        shape = create_shape()
+        path = estimator.load_path(shape)
+        self.assertIs(estimator.load_path(shape), path)
+
+        point = shape.points.get(order=45)
+        point.longitude = -2.001
+        point.save()
+
+        new_path = estimator.load_path(shape)
+        self.assertIsNot(new_path, path)
+        self.assertAlmostEqual(new_path.point(45).long, -2.001)
+
+    def test_path_loaded_from_shared_cache(self):
+        shape = create_shape()
+        path = estimator.load_path(shape)
+
+        # As another worker would, without this process's copy
+        path_cache.local_paths.clear()
+        with self.assertNumQueries(0):
+            copy = estimator.load_path(shape)
+
+        self.assertIsNot(copy, path)
+        self.assertEqual(copy.shape_id, shape.id)
+        numpy.testing.assert_array_equal(copy.latitudes, path.latitudes)
+        numpy.testing.assert_array_equal(copy.cumulative_distances, path.cumulative_distances)
+        numpy.testing.assert_allclose(copy.speed_table, path.speed_table, rtol=1e-6)
+
+
+class StopProjectionTestCase(TransactionTestCase):
+    def setUp(self):
+        self.shape = create_shape()
+        self.stop = models.Stop.objects.create(name="Stop", latitude=52.01, longitude=-2.0001)
+
+    def path(self) -> estimator.Path:
+        # A fresh copy each time, as another worker would have
+        path_cache.local_paths.clear()
+        return estimator.load_path(self.shape)
+
+    def test_projection_persisted(self):
+        path = self.path()
+        position = estimator.get_stop_position(path, self.stop)
+        self.assertAlmostEqual(position.distance_along, path.cumulative_distances[20], delta=1)
+
+        projection = models.ShapeStopProjection.objects.get(shape=self.shape, stop=self.stop)
+        self.assertEqual(projection.segment_index, position.segment_index)
+        self.assertAlmostEqual(projection.distance_along, position.distance_along)
+        self.assertEqual(projection.generation, path.generation)
+
+        # A freshly built path reads it back rather than projecting the stop again
+        with unittest.mock.patch.object(estimator, "project_stop") as project_stop:
+            self.assertEqual(estimator.get_stop_position(self.path(), self.stop), position)
+        project_stop.assert_not_called()
+
+    def test_projection_cleared_when_stop_moves(self):
+        estimator.get_stop_position(self.path(), self.stop)
+
+        self.stop.latitude = 52.015
+        self.stop.save()
+
+        self.assertFalse(models.ShapeStopProjection.objects.filter(stop=self.stop).exists())
+        path = self.path()
+        self.assertAlmostEqual(
+            estimator.get_stop_position(path, self.stop).distance_along, path.cumulative_distances[30], delta=1
+        )
+
+    def test_projection_cleared_when_shape_edited(self):
+        estimator.get_stop_position(self.path(), self.stop)
+
+        with transaction.atomic():
+            for point in self.shape.points.filter(order__lt=10):
+                point.latitude -= 0.005
+                point.save()
+
+            # However many points are saved, the shape is only cleared once
+            self.assertEqual(len(transaction.get_connection().run_on_commit), 1)
+
+        self.assertFalse(models.ShapeStopProjection.objects.filter(shape=self.shape).exists())
+
+    def test_projection_from_old_geometry_ignored(self):
+        old_path = self.path()
+
+        point = self.shape.points.get(order=0)
+        point.latitude -= 0.005
+        point.save()
+
+        # An estimator still working from the path before the edit writes its projection afterwards
+        estimator.get_stop_position(old_path, self.stop)
+
+        path = self.path()
+        self.assertNotEqual(path.generation, old_path.generation)
+        position = estimator.get_stop_position(path, self.stop)
+        self.assertAlmostEqual(position.distance_along, path.cumulative_distances[20], delta=1)
+        self.assertEqual(
+            list(models.ShapeStopProjection.objects.values_list("generation", flat=True)), [path.generation]
+        )
+
+
+def build_path(points: typing.List[typing.Tuple[float, float]], speed_ms: float = 10.0) -> estimator.Path:
+    path = estimator.Path(
+        points=[estimator.Point(lat=lat, long=long) for lat, long in points],
+        speed_table=numpy.full((len(points) - 1, 7, estimator.SPEED_BINS_PER_DAY), speed_ms)
+    )
+    path.calculate_distances()
+    return path
+
+
+class PathProjectionTestCase(SimpleTestCase):
+    # North for 20 points, then back south about 20m to the east of the way out
+    OUT = [(52.0 + i * 0.0005, -2.0) for i in range(20)]
+    BACK = [(52.0 + i * 0.0005, -1.9997) for i in reversed(range(20))]
+
+    def setUp(self):
+        self.path = build_path(self.OUT + self.BACK)
+
+    def test_projection_matches_every_segment(self):
+        rng = numpy.random.default_rng(1)
+        for lat, long in zip(rng.uniform(51.999, 52.011, 200), rng.uniform(-2.001, -1.9987, 200)):
+            target = self.path.to_coords(lat, long)
+            expected = self.path.project_onto_segments(target, numpy.arange(len(self.path.distances)), 0, 0.0)
+            projection = self.path.project(estimator.Point(lat=lat, long=long))
+
+            self.assertAlmostEqual(projection.cross_track_error, numpy.sqrt(expected[2]), places=6)
+
+    def test_doubling_back(self):
+        # On the way back, beside the way out; the nearest leg is the one it's on
+        projection = self.path.project(estimator.Point(lat=52.005, long=-1.9997))
+        self.assertGreaterEqual(projection.segment_index, 20)
+        self.assertAlmostEqual(projection.distance_along, self.path.cumulative_distances[29], delta=1)
+
+        projection = self.path.project(estimator.Point(lat=52.005, long=-1.99998))
+        self.assertLess(projection.segment_index, 19)
+        self.assertAlmostEqual(projection.distance_along, self.path.cumulative_distances[10], delta=1)
+
+    def test_min_distance_only_looks_ahead(self):
+        # Nearest to the way out, but the vehicle is known to have turned back already
+        turn = self.path.cumulative_distances[20]
+        projection = self.path.project(estimator.Point(lat=52.005, long=-1.99998), min_distance=turn)
+
+        self.assertGreaterEqual(projection.segment_index, 20)
+        self.assertAlmostEqual(projection.distance_along, self.path.cumulative_distances[29], delta=1)
+        self.assertAlmostEqual(projection.cross_track_error, 18.3, delta=1)
+
+    def test_min_distance_within_segment(self):
+        # A point behind the known position, and off to the west of the way out, is held at that position
+        known = self.path.distance_along(5, 0.5)
+        projection = self.path.project(estimator.Point(lat=52.0025, long=-2.0004), min_distance=known)
+
+        self.assertEqual(projection.segment_index, 5)
+        self.assertAlmostEqual(projection.fraction, 0.5)
+        self.assertAlmostEqual(projection.distance_along, known)
+
+
+class TravelTimeTableTestCase(SimpleTestCase):
+    def setUp(self):
+        self.path = build_path([(52.0 + i * 0.0005, -2.0) for i in range(10)])
+        # Slower the further along the path, and twice as fast in the first hour of the week
+        for i in range(len(self.path.distances)):
+            self.path.speed_table[i] = 5.0 + i
+        self.path.speed_table[:, 0, 0] *= 2
+        self.stops = [0.0, 120.0, 300.0, float(self.path.length)]
+
+    def test_matches_travel_time(self):
+        table = self.path.stop_travel_times(self.stops)
+        self.assertEqual(table.shape, (3, estimator.SPEED_BINS_PER_WEEK))
+
+        monday = datetime.datetime(2024, 6, 3)
+        for week_bin in (0, 1, estimator.SPEED_BINS_PER_WEEK - 1):
+            start_time = monday + datetime.timedelta(seconds=week_bin * estimator.SPEED_BIN_SECONDS)
+            for leg, (start, end) in enumerate(zip(self.stops, self.stops[1:])):
+                self.assertAlmostEqual(table[leg, week_bin], self.path.travel_time(start, end, start_time), places=6)
+
+        self.assertAlmostEqual(table[0, 0] * 2, table[0, 1], places=6)
+
+    def test_shared_between_journeys(self):
+        table = self.path.stop_travel_times(self.stops)
+
+        self.assertIs(self.path.stop_travel_times(list(self.stops)), table)
+        self.assertIsNot(self.path.stop_travel_times(self.stops[1:]), table)
+
+
+class EstimateWriteTestCase(TestCase):
+    def setUp(self):
+        journey = models.Journey.objects.create(code="J1")
+        stop = models.Stop.objects.create(name="Stop", latitude=52.0, longitude=-2.0)
+        self.estimate = datetime.datetime(2024, 5, 31, 10, 0, tzinfo=datetime.timezone.utc)
+        models.JourneyPoint.objects.create(
+            journey=journey, stop=stop, arrival_time=self.estimate, estimated_arrival=self.estimate
+        )
+
+    def test_small_change_not_written(self):
+        point = models.JourneyPoint.objects.get()
+        point.estimated_arrival = self.estimate + datetime.timedelta(seconds=estimator.estimate_write_threshold() - 1)
+
+        with self.assertNumQueries(0):
+            estimator.save_estimates([point])
+
+        self.assertEqual(models.JourneyPoint.objects.get().estimated_arrival, self.estimate)
+
+    def test_change_over_threshold_written(self):
+        point = models.JourneyPoint.objects.get()
+        point.estimated_arrival = self.estimate + datetime.timedelta(seconds=estimator.estimate_write_threshold())
+        point.estimated_departure = self.estimate
+
+        estimator.save_estimates([point])
+
+        point = models.JourneyPoint.objects.get()
+        self.assertEqual(
+            point.estimated_arrival, self.estimate + datetime.timedelta(seconds=estimator.estimate_write_threshold())
+        )
+        self.assertEqual(point.estimated_departure, self.estimate)
+
+    def test_cleared_estimate_written(self):
+        point = models.JourneyPoint.objects.get()
+        point.estimated_arrival = None
+
+        estimator.save_estimates([point])
+
+        self.assertIsNone(models.JourneyPoint.objects.get().estimated_arrival)
+
+
+class EstimateBufferTestCase(TestCase):
+    def setUp(self):
+        journey = models.Journey.objects.create(code="J1")
+        stop = models.Stop.objects.create(name="Stop", latitude=52.0, longitude=-2.0)
+        self.estimate = datetime.datetime(2024, 5, 31, 10, 0, tzinfo=datetime.timezone.utc)
+        models.JourneyPoint.objects.create(
+            journey=journey, stop=stop, arrival_time=self.estimate, estimated_arrival=self.estimate
+        )
+        estimator.estimate_buffer = {}
+
+    def tearDown(self):
+        estimator.estimate_buffer = None
+
+    def test_written_on_flush(self):
+        point = models.JourneyPoint.objects.get()
+        point.estimated_arrival = self.estimate + datetime.timedelta(minutes=1)
+
+        estimator.write_estimates([point])
+        self.assertEqual(models.JourneyPoint.objects.get().estimated_arrival, self.estimate)
+
+        estimator.flush_estimate_buffer()
+        self.assertEqual(
+            models.JourneyPoint.objects.get().estimated_arrival, self.estimate + datetime.timedelta(minutes=1)
+        )
+
+    def test_served_point_not_overwritten(self):
+        point = models.JourneyPoint.objects.get()
+        point.estimated_arrival = self.estimate + datetime.timedelta(minutes=1)
+        estimator.write_estimates([point])
+
+        # The vehicle reaches the stop before the buffer is flushed
+        served = models.JourneyPoint.objects.get()
+        served.real_time_arrival = self.estimate
+        served.estimated_arrival = None
+        estimator.save_journey_point(served)
+
+        estimator.flush_estimate_buffer()
+
+        point = models.JourneyPoint.objects.get()
+        self.assertEqual(point.real_time_arrival, self.estimate)
+        self.assertIsNone(point.estimated_arrival)
+
+
+class BlockDelayTestCase(TestCase):
+    START = datetime.datetime(2024, 5, 31, 10, 0, tzinfo=datetime.timezone.utc)
+
+    def setUp(self):
+        vehicle = models.Vehicle.objects.create(name="Bus", registration_plate="EMF 1")
+        stops = [models.Stop.objects.create(name=f"Stop {i}", latitude=52.0, longitude=-2.0) for i in range(3)]
+
+        self.journey = models.Journey.objects.create(code="J1", vehicle=vehicle)
+        models.JourneyPoint.objects.create(
+            journey=self.journey, stop=stops[0], order=1, departure_time=self.time(0)
+        )
+        models.JourneyPoint.objects.create(
+            journey=self.journey, stop=stops[2], order=2, arrival_time=self.time(55)
+        )
+
+        # Departs an hour after the first journey, with a five minute dwell at the middle stop
+        self.next_journey = models.Journey.objects.create(code="J2", vehicle=vehicle, forms_from=self.journey)
+        self.next_points = [
+            models.JourneyPoint.objects.create(
+                journey=self.next_journey, stop=stops[2], order=1, departure_time=self.time(60)
+            ),
+            models.JourneyPoint.objects.create(
+                journey=self.next_journey, stop=stops[1], order=2, arrival_time=self.time(70),
+                departure_time=self.time(75)
+            ),
+            models.JourneyPoint.objects.create(
+                journey=self.next_journey, stop=stops[0], order=3, arrival_time=self.time(85)
+            ),
+        ]
+
+    def time(self, minutes: int) -> datetime.datetime:
+        return self.START + datetime.timedelta(minutes=minutes)
+
+    def estimates(self):
+        return [
+            (point.estimated_arrival, point.estimated_departure)
+            for point in models.JourneyPoint.objects.filter(journey=self.next_journey).order_by("order")
+        ]
+
+    def test_delay_recovered_by_dwell(self):
+        # Ready to leave at 11:05 after the minimum layover, five minutes late
+        estimator.propagate_block_delay(self.journey, self.time(63), self.START)
+
+        self.assertEqual(self.estimates(), [
+            (self.time(65), self.time(65)),
+            (self.time(75), None),
+            (None, None),
+        ])
+
+    def test_delay_partly_recovered_by_dwell(self):
+        estimator.propagate_block_delay(self.journey, self.time(68), self.START)
+
+        self.assertEqual(self.estimates(), [
+            (self.time(70), self.time(70)),
+            (self.time(80), self.time(80)),
+            (self.time(90), None),
+        ])
+
+    def test_delay_absorbed_by_layover(self):
+        estimator.propagate_block_delay(self.journey, self.time(57), self.START)
+
+        self.assertEqual(self.estimates(), [(None, None)] * 3)
+
+    def test_started_journey_not_changed(self):
+        self.next_journey.real_time_state = models.Journey.RT_STATE_ACTIVE
+        self.next_journey.save()
+
+        estimator.propagate_block_delay(self.journey, self.time(68), self.START)
+
+        self.assertEqual(self.estimates(), [(None, None)] * 3)
+
+
+class EstimateSweepTestCase(TestCase):
+    def setUp(self):
+        self.journey_ids = {
+            str(models.Journey.objects.create(code=f"J{i}", real_time_state=models.Journey.RT_STATE_ACTIVE).id)
+            for i in range(25)
+        }
+        models.Journey.objects.create(code="Planned")
+
+    def tearDown(self):
+        cache.delete_many([estimator.ESTIMATE_SWEEP_TICK_KEY, f"{estimator.ESTIMATE_SWEEP_TICK_KEY}_lock"])
+
+    def test_sweep_started_once_per_interval(self):
+        with unittest.mock.patch.object(estimator.update_journey_estimates_chunk, "apply_async") as apply_async:
+            estimator.update_journey_estimates()
+            # A second scheduler firing in the same interval
+            estimator.update_journey_estimates()
+
+        chunks = [call.args[0][0] for call in apply_async.call_args_list]
+        self.assertEqual(sorted(len(chunk) for chunk in chunks), [5, 10, 10])
+        self.assertEqual(set(journey_id for chunk in chunks for journey_id in chunk), self.journey_ids)
+        self.assertEqual(len(set(call.args[0][1] for call in apply_async.call_args_list)), 1)
+
+    def test_superseded_chunk_stops(self):
+        tick = int(time.time())
+        cache.set(estimator.ESTIMATE_SWEEP_TICK_KEY, tick, None)
+        journeys = list(models.Journey.objects.filter(id__in=self.journey_ids))
+
+        with unittest.mock.patch.object(
+                estimator, "kalman_predict_journeys", return_value={journey.id: 100.0 for journey in journeys}
+        ), unittest.mock.patch.object(estimator, "update_journey_from_estimate") as update_journey_from_estimate:
+            estimator.update_journey_estimates_chunk(
+                [str(journey.id) for journey in journeys[:10]], tick - estimator.ESTIMATE_SWEEP_INTERVAL
+            )
+            update_journey_from_estimate.assert_not_called()
+
+            estimator.update_journey_estimates_chunk([str(journey.id) for journey in journeys[:10]], tick)
+            self.assertEqual(update_journey_from_estimate.call_count, 10)
+
+
+class LiveStateTestCase(TestCase):
+    def setUp(self):
+        self.journey = models.Journey.objects.create(code="J1", real_time_state=models.Journey.RT_STATE_ACTIVE)
+
+    def tearDown(self):
+        cache.delete(live_state.state_key(self.journey.id))
+
+    def state(self, t: int) -> dict:
+        return {"x": 1000.0 - t * 10, "u": 10.0, "p": [2.5, 0.0, 1.0], "t": t}
+
+    def test_latest_state_recovered(self):
+        for t in range(5):
+            live_state.set_state(self.journey, self.state(t))
+
+        # Nothing is written until the interval ends, and then only the latest state
+        self.journey.refresh_from_db()
+        self.assertIsNone(self.journey.kalman_estimator_state)
+        with self.assertNumQueries(2):
+            live_state.flush_states()
+        with self.assertNumQueries(1):
+            live_state.flush_states()
+
+        # The cache is lost
+        cache.delete(live_state.state_key(self.journey.id))
+        journey = models.Journey.objects.get(id=self.journey.id)
+        self.assertEqual(live_state.get_state(journey), self.state(4))
+        self.assertEqual(cache.get(live_state.state_key(self.journey.id)), self.state(4))
+
+    def test_forced_flush(self):
+        live_state.set_state(self.journey, self.state(0), force_flush=True)
+
+        self.journey.refresh_from_db()
+        self.assertEqual(self.journey.kalman_estimator_state, self.state(0))
+
+    def test_cleared_state(self):
+        live_state.set_state(self.journey, self.state(0), force_flush=True)
+        live_state.clear_state(self.journey)
+        live_state.flush_states()
+
+        journey = models.Journey.objects.get(id=self.journey.id)
+        self.assertIsNone(journey.kalman_estimator_state)
+        self.assertIsNone(live_state.get_state(journey))
+
+
+class ReportCoalescingTestCase(TestCase):
+    def setUp(self):
+        self.vehicle = models.Vehicle.objects.create(name="Bus", registration_plate="EMF 1")
+        self.vehicle_id = str(self.vehicle.id)
+
+    def tearDown(self):
+        cache.delete_many([estimator.report_pending_key(self.vehicle_id), estimator.report_dirty_key(self.vehicle_id)])
+
+    def test_burst_queues_one_report(self):
+        with unittest.mock.patch.object(estimator.vehicle_report, "apply_async") as apply_async:
+            for _ in range(5):
+                estimator.schedule_vehicle_report(self.vehicle_id)
+
+        apply_async.assert_called_once_with((self.vehicle_id,), queue=None)
+        self.assertTrue(cache.get(estimator.report_dirty_key(self.vehicle_id)))
+
+    def test_report_during_run_is_requeued(self):
+        cache.add(estimator.report_pending_key(self.vehicle_id), True, estimator.REPORT_PENDING_TIMEOUT)
+
+        def process_vehicle_report(vehicle_id):
+            # A fix arrives while the estimator is running
+            estimator.schedule_vehicle_report(vehicle_id)
+
+        with unittest.mock.patch.object(estimator, "process_vehicle_report", process_vehicle_report), \
+                unittest.mock.patch.object(estimator.vehicle_report, "apply_async") as apply_async:
+            estimator.vehicle_report(self.vehicle_id)
+
+        apply_async.assert_called_once_with((self.vehicle_id,), queue=None)
+        self.assertTrue(cache.get(estimator.report_pending_key(self.vehicle_id)))
+
+    def test_quiet_report_releases_vehicle(self):
+        cache.add(estimator.report_pending_key(self.vehicle_id), True, estimator.REPORT_PENDING_TIMEOUT)
+
+        with unittest.mock.patch.object(estimator, "process_vehicle_report"), \
+                unittest.mock.patch.object(estimator.vehicle_report, "apply_async") as apply_async:
+            estimator.vehicle_report(self.vehicle_id)
+
+        apply_async.assert_not_called()
+        self.assertIsNone(cache.get(estimator.report_pending_key(self.vehicle_id)))
+
+
+class EstimatorQueueTestCase(TestCase):
+    def setUp(self):
+        self.vehicles = [
+            models.Vehicle.objects.create(name=f"Bus {i}", registration_plate=f"EMF {i}") for i in range(20)
+        ]
+        for vehicle in self.vehicles:
+            models.Journey.objects.create(
+                code=f"J {vehicle.name}", vehicle=vehicle, real_time_state=models.Journey.RT_STATE_ACTIVE
+            )
+
+    def tearDown(self):
+        cache.delete_many([estimator.ESTIMATE_SWEEP_TICK_KEY, f"{estimator.ESTIMATE_SWEEP_TICK_KEY}_lock"] + [
+            key for vehicle in self.vehicles for key in (
+                estimator.report_pending_key(str(vehicle.id)), estimator.report_dirty_key(str(vehicle.id)),
+                f"tracking_estimator_lock:{vehicle.id}"
+            )
+        ])
+
+    def test_default_queue(self):
+        self.assertIsNone(estimator.estimator_queue(self.vehicles[0].id))
+
+    @override_settings(TRACKING_ESTIMATOR_PARTITIONS=4)
+    def test_partitioned_queues(self):
+        queues = {vehicle.id: estimator.estimator_queue(vehicle.id) for vehicle in self.vehicles}
+        self.assertTrue(set(queues.values()) <= {f"estimator-{i}" for i in range(4)})
+        self.assertGreater(len(set(queues.values())), 1)
+        # A vehicle's work always goes to the same queue
+        self.assertEqual(estimator.estimator_queue(str(self.vehicles[0].id)), queues[self.vehicles[0].id])
+
+        vehicle_id = str(self.vehicles[0].id)
+        with unittest.mock.patch.object(estimator.vehicle_report, "apply_async") as apply_async:
+            estimator.schedule_vehicle_report(vehicle_id)
+        apply_async.assert_called_once_with((vehicle_id,), queue=queues[self.vehicles[0].id])
+
+        with unittest.mock.patch.object(estimator.update_journey_estimates_chunk, "apply_async") as apply_async:
+            estimator.update_journey_estimates()
+        for call in apply_async.call_args_list:
+            journey_queues = {
+                queues[journey.vehicle_id] for journey in models.Journey.objects.filter(id__in=call.args[0][0])
+            }
+            self.assertEqual(journey_queues, {call.kwargs["queue"]})
+
+    def test_report_retried_while_locked(self):
+        vehicle_id = str(self.vehicles[0].id)
+        cache.add(estimator.report_pending_key(vehicle_id), True, estimator.REPORT_PENDING_TIMEOUT)
+
+        with estimator.vehicle_lock(vehicle_id) as acquired, \
+                unittest.mock.patch.object(estimator, "process_vehicle_report") as process_vehicle_report, \
+                unittest.mock.patch.object(estimator.vehicle_report, "apply_async") as apply_async:
+            self.assertTrue(acquired)
+            start = time.monotonic()
+            estimator.vehicle_report(vehicle_id)
+
+        self.assertLess(time.monotonic() - start, estimator.LOCK_RETRY_DELAY)
+        process_vehicle_report.assert_not_called()
+        apply_async.assert_called_once_with((vehicle_id,), queue=None, countdown=estimator.LOCK_RETRY_DELAY)
+        # Later reports are still coalesced into the retry
+        self.assertTrue(cache.get(estimator.report_pending_key(vehicle_id)))
+
+        with unittest.mock.patch.object(estimator, "process_vehicle_report") as process_vehicle_report:
+            estimator.vehicle_report(vehicle_id)
+        process_vehicle_report.assert_called_once_with(vehicle_id)
+
+    def test_sweep_skips_locked_vehicle(self):
+        journeys = list(models.Journey.objects.filter(vehicle__in=self.vehicles[:2]))
+
+        with estimator.vehicle_lock(self.vehicles[0].id), \
+                unittest.mock.patch.object(estimator, "update_journeys_from_estimates") as update_journeys:
+            estimator.update_journey_estimates_chunk([str(journey.id) for journey in journeys], int(time.time()))
+
+        self.assertEqual([journey.vehicle_id for journey in update_journeys.call_args.args[0]], [self.vehicles[1].id])
+
+    @override_settings(TRACKING_ESTIMATOR_PARTITIONS=4)
+    def test_no_lock_when_partitioned(self):
+        with estimator.vehicle_lock(self.vehicles[0].id), estimator.vehicle_lock(self.vehicles[0].id) as acquired:
+            self.assertTrue(acquired)
+
+
+class EstimatorServiceTestCase(TestCase):
+    def setUp(self):
+        self.command = importlib.import_module("tracking.management.commands.estimator-service")
+
+    def service(self):
+        async def create():
+            return self.command.EstimatorService()
+
+        service = asyncio.run(create())
+        self.addCleanup(service.db_thread.shutdown)
+        return service
+
+    def test_enqueue_once_while_pending(self):
+        service = self.service()
+        for _ in range(3):
+            service.enqueue("vehicle-1")
+        service.enqueue("vehicle-2")
+
+        self.assertEqual(service.queue.qsize(), 2)
+
+    def test_failed_report_logged(self):
+        with unittest.mock.patch.object(estimator, "process_vehicle_report", side_effect=RuntimeError), \
+                self.assertLogs(level="ERROR"):
+            self.command.EstimatorService.process_report("vehicle-1")
+
+    def test_unknown_vehicle_logged(self):
+        with unittest.mock.patch.object(
+                estimator, "process_vehicle_report", side_effect=models.Vehicle.DoesNotExist
+        ), self.assertLogs(level="WARNING"):
+            self.command.EstimatorService.process_report("vehicle-1")
+
+    def test_active_vehicle_ids(self):
+        active = models.Vehicle.objects.create(name="Bus 1", registration_plate="EMF 1")
+        idle = models.Vehicle.objects.create(name="Bus 2", registration_plate="EMF 2")
+        models.Journey.objects.create(code="J1", vehicle=active, real_time_state=models.Journey.RT_STATE_ACTIVE)
+        models.Journey.objects.create(code="J2", vehicle=active, real_time_state=models.Journey.RT_STATE_ACTIVE)
+        models.Journey.objects.create(code="J3", vehicle=idle, real_time_state=models.Journey.RT_STATE_COMPLETED)
+        models.Journey.objects.create(code="J4", real_time_state=models.Journey.RT_STATE_ACTIVE)
+
+        self.assertEqual(self.command.EstimatorService.active_vehicle_ids(), [str(active.id)])
+
+
+class IdleReportTestCase(TransactionTestCase):
+    NOW = datetime.datetime(2024, 5, 31, 12, 0, tzinfo=datetime.timezone.utc)
+
+    def setUp(self):
+        self.vehicle = models.Vehicle.objects.create(name="Bus", registration_plate="EMF 1")
+        origin = models.Stop.objects.create(name="Origin", latitude=52.01, longitude=-2.0)
+        terminus = models.Stop.objects.create(name="Terminus", latitude=52.0, longitude=-2.0)
+
+        # Timetabled to have finished 40 minutes ago, well past the realtime cutoff
+        self.journey = models.Journey.objects.create(code="J1", vehicle=self.vehicle)
+        models.JourneyPoint.objects.create(
+            journey=self.journey, stop=origin, order=1, departure_time=self.NOW - datetime.timedelta(minutes=70)
+        )
+        self.terminus_point = models.JourneyPoint.objects.create(
+            journey=self.journey, stop=terminus, order=2, arrival_time=self.NOW - datetime.timedelta(minutes=40)
+        )
+
+        # Stopped at the terminus
+        models.VehiclePosition.objects.create(
+            vehicle=self.vehicle, timestamp=self.NOW, latitude=52.0, longitude=-2.0, velocity_ms=0.0
+        )
+
+    def test_stationary_without_journey_skipped(self):
+        estimator.process_vehicle_report(str(self.vehicle.id))
+
+        self.assertIsNone(models.JourneyPoint.objects.get(id=self.terminus_point.id).real_time_arrival)
+        self.assertEqual(models.Journey.objects.get(id=self.journey.id).real_time_state, self.journey.real_time_state)
+
+    def test_late_active_journey_completed(self):
+        self.journey.real_time_state = models.Journey.RT_STATE_ACTIVE
+        self.journey.save()
+
+        estimator.process_vehicle_report(str(self.vehicle.id))
+
+        self.assertEqual(models.JourneyPoint.objects.get(id=self.terminus_point.id).real_time_arrival, self.NOW)
+        self.assertEqual(
+            models.Journey.objects.get(id=self.journey.id).real_time_state, models.Journey.RT_STATE_COMPLETED
+        )
+
+
+class TelemetryTestCase(SimpleTestCase):
+    def setUp(self):
+        telemetry.flush_counters()
+        self.key = f"tracking_test_counter:{self.id()}"
+
+    def tearDown(self):
+        cache.delete(self.key)
+
+    def test_counts_aggregated_until_flush(self):
+        with unittest.mock.patch.object(cache, "incr", wraps=cache.incr) as incr, \
+                unittest.mock.patch.object(cache, "add", wraps=cache.add) as add:
+            for _ in range(100):
+                telemetry.increment(self.key)
+            incr.assert_not_called()
+            add.assert_not_called()
+            self.assertIsNone(cache.get(self.key))
+
+            # The counter doesn't exist yet, so it's added
+            telemetry.flush_counters()
+            self.assertEqual(cache.get(self.key), 100)
+            self.assertEqual(add.call_count, 1)
+
+            telemetry.increment(self.key, 5)
+            telemetry.flush_counters()
+            self.assertEqual(cache.get(self.key), 105)
+            self.assertEqual(add.call_count, 1)
+            self.assertEqual(incr.call_count, 2)
+
+    def test_flushed_after_interval(self):
+        with unittest.mock.patch.object(telemetry, "COUNTER_FLUSH_INTERVAL", 0):
+            telemetry.increment(self.key, 3)
+
+        self.assertEqual(cache.get(self.key), 3)
+
+    def test_trace_histograms(self):
+        before = telemetry.stage_histograms().get("kalman", {"buckets": [("+Inf", 0)], "queries": 0})
+
+        for _ in range(3):
+            with telemetry.trace("report"):
+                with telemetry.stage("kalman"):
+                    pass
+
+        after = telemetry.stage_histograms()["kalman"]
+        self.assertEqual(after["buckets"][-1][1] - before["buckets"][-1][1], 3)
+        # Under a millisecond each
+        self.assertEqual(after["buckets"][0][1] - before["buckets"][0][1], 3)
+
+
+class StopIndexTestCase(TransactionTestCase):
+    def test_within_matches_geodesic_distance(self):
+        rng = numpy.random.default_rng(1)
+        stops = [(i, lat, long) for i, (lat, long) in enumerate(zip(
+            rng.uniform(52.03, 52.05, 500), rng.uniform(-2.39, -2.36, 500)
+        ))]
+        index = stop_index.StopIndex(stops)
+
+        lat, long, radius = 52.04, -2.375, 300
+        expected = {
+            stop_id for stop_id, stop_lat, stop_long in stops
+            if geographiclib.geodesic.Geodesic.WGS84.Inverse(lat, long, stop_lat, stop_long)["s12"] < radius
+        }
+        self.assertGreater(len(expected), 0)
+        self.assertEqual(set(index.within(lat, long, radius)), expected)
+
+    def test_empty_index(self):
+        self.assertEqual(stop_index.StopIndex([]).within(52.0, -2.0, 100), [])
+
+    def test_index_follows_stop_edits(self):
+        stop = models.Stop.objects.create(name="Stop", latitude=52.0, longitude=-2.0)
+        self.assertEqual(stop_index.stops_near(52.0, -2.0, 75), [stop.id])
+        with self.assertNumQueries(0):
+            stop_index.stops_near(52.0, -2.0, 75)
+
+        stop.latitude = 52.01
+        stop.save()
+        self.assertEqual(stop_index.stops_near(52.0, -2.0, 75), [])
+        self.assertEqual(stop_index.stops_near(52.01, -2.0, 75), [stop.id])
+
+        stop.delete()
+        self.assertEqual(stop_index.stops_near(52.01, -2.0, 75), [])
+
+
+class DayPlanTestCase(TransactionTestCase):
+    START = datetime.datetime(2024, 5, 31, 10, 0, tzinfo=datetime.timezone.utc)
+
+    def setUp(self):
+        self.vehicle = models.Vehicle.objects.create(name="Bus", registration_plate="EMF 1")
+        self.stop = models.Stop.objects.create(name="Stop", latitude=52.0, longitude=-2.0)
+        self.journey = models.Journey.objects.create(code="J1", vehicle=self.vehicle)
+        self.next_journey = models.Journey.objects.create(code="J2", vehicle=self.vehicle, forms_from=self.journey)
+        self.points = [
+            models.JourneyPoint.objects.create(journey=journey, stop=self.stop, order=order, departure_time=time)
+            for journey, order, time in (
+                (self.journey, 1, self.START),
+                (self.journey, 2, self.START + datetime.timedelta(minutes=30)),
+                (self.next_journey, 1, self.START + datetime.timedelta(hours=1)),
+            )
+        ]
+
+    def plan(self) -> day_plan.DayPlan:
+        return day_plan.get_plan(self.vehicle.id, self.START.date())
+
+    def test_plan(self):
+        plan = self.plan()
+        self.assertEqual(plan.journey_ids, [self.journey.id, self.next_journey.id])
+        self.assertEqual(plan.following_journey_ids(self.journey), [self.next_journey.id])
+        self.assertEqual(plan.last_point_id(self.journey), self.points[1].id)
+        self.assertTrue(plan.in_service(self.START, datetime.timedelta(0), datetime.timedelta(0)))
+        self.assertFalse(plan.in_service(
+            self.START + datetime.timedelta(minutes=45), datetime.timedelta(minutes=5), datetime.timedelta(minutes=5)
+        ))
+
+    def test_plan_reused_through_real_time_updates(self):
+        plan = self.plan()
+
+        point = models.JourneyPoint.objects.get(id=self.points[0].id)
+        point.estimated_arrival = self.START
+        point.real_time_departure = self.START
+        point.save()
+        journey = models.Journey.objects.get(id=self.journey.id)
+        journey.real_time_state = models.Journey.RT_STATE_ACTIVE
+        journey.save()
+
+        with self.assertNumQueries(0):
+            self.assertIs(self.plan(), plan)
+
+    def test_plan_rebuilt_when_schedule_changes(self):
+        plan = self.plan()
+
+        point = models.JourneyPoint.objects.get(id=self.points[1].id)
+        point.departure_time = self.START + datetime.timedelta(minutes=40)
+        point.save()
+
+        plan = self.rebuilt_plan(plan)
+        self.assertEqual(
+            plan.journeys[self.journey.id].end_time, self.START + datetime.timedelta(minutes=40)
+        )
+
+        next_journey = models.Journey.objects.get(id=self.next_journey.id)
+        next_journey.forms_from = None
+        next_journey.save()
+
+        plan = self.rebuilt_plan(plan)
+        self.assertEqual(plan.following_journey_ids(self.journey), [])
+
+        models.JourneyPoint.objects.get(id=self.points[1].id).delete()
+        plan = self.rebuilt_plan(plan)
+        self.assertEqual(plan.last_point_id(self.journey), self.points[0].id)
+
+        next_journey.vehicle = None
+        next_journey.save()
+        plan = self.rebuilt_plan(plan)
+        self.assertEqual(plan.journey_ids, [self.journey.id])
+
+    def rebuilt_plan(self, plan: day_plan.DayPlan) -> day_plan.DayPlan:
+        new_plan = self.plan()
+        self.assertIsNot(new_plan, plan)
+        return new_plan
+
+
+class SpeedTableTestCase(TestCase):
+    def setUp(self):
+        self.shape = create_shape(points=5)
+        self.points = list(self.shape.points.order_by("order"))
+
+    def add_speed(self, point: models.ShapePoint, speed_kmh: float, direction: int):
+        models.ShapePointAverageSpeed.objects.create(
+            point=point, speed_kmh=speed_kmh, direction=direction,
+            validity_start_time=datetime.time(0, 0), validity_end_time=datetime.time(23, 59),
+            valid_monday=True, valid_tuesday=True, valid_wednesday=True, valid_thursday=True, valid_friday=True,
+            valid_saturday=True, valid_sunday=True,
+        )
+
+    def segment_speeds_kmh(self, reverse: bool) -> typing.List[float]:
+        speed_table = estimator.build_path(self.shape, reverse).speed_table
+        self.assertTrue(numpy.all(speed_table == speed_table[:, :1, :1]))
+        return [round(float(speed) / consts.KMH_TO_MS, 6) for speed in speed_table[:, 0, 0]]
+
+    def test_speeds_by_direction(self):
+        # Speeds are stored against the point at the start of each segment in the shape's order, for either direction
+        self.add_speed(self.points[0], 10, models.ShapePointAverageSpeed.DIRECTION_FORWARD)
+        self.add_speed(self.points[0], 20, models.ShapePointAverageSpeed.DIRECTION_REVERSE)
+        self.add_speed(self.points[3], 40, models.ShapePointAverageSpeed.DIRECTION_REVERSE)
+
+        default = estimator.DEFAULT_SPEED_KMH
+        self.assertEqual(self.segment_speeds_kmh(reverse=False), [10, default, default, default])
+        # Travelled in reverse the shape's last segment comes first
+        self.assertEqual(self.segment_speeds_kmh(reverse=True), [40, default, default, 20])
+
+
+def edge(length: float) -> map_lines.EdgeProperties:
+    return map_lines.EdgeProperties(id=None, data={"length": length})
+
+
+class GraphTestCase(SimpleTestCase):
+    def test_csr(self):
+        graph = map_lines.Graph()
+        a, b, c = shapely.Point(0, 0), shapely.Point(1, 0), shapely.Point(1, 1)
+        graph.add_edge(a, b, 2.0, edge(2.0))
+        graph.add_edge(a, b, 1.0, edge(1.0), backward_direction=False)
+        graph.add_edge(b, c, 3.0, edge(3.0), forward_direction=False)
+
+        # Only the cheapest of the parallel edges a -> b is kept, c -> b is the only way between b and c
+        numpy.testing.assert_array_equal(graph.csr().toarray(), [
+            [0.0, 1.0, 0.0],
+            [2.0, 0.0, 0.0],
+            [0.0, 3.0, 0.0],
+        ])
+
+        path = graph.shortest_path(c, a)
+        self.assertEqual([(p.source_point, p.target_point) for p in path], [(c, b), (b, a)])
+        self.assertEqual([p.direction for p in path], [map_lines.EdgeDirection.BACKWARD] * 2)
+        self.assertEqual([p.data.data["length"] for p in path], [3.0, 2.0])
+        self.assertIsNone(graph.shortest_path(a, c))
+
+    def test_connected_components(self):
+        graph = map_lines.Graph()
+        for i in range(3):
+            graph.add_edge(shapely.Point(i, 0), shapely.Point(i + 1, 0), 1.0, edge(1.0), backward_direction=False)
+        graph.add_edge(shapely.Point(10, 10), shapely.Point(11, 10), 1.0, edge(1.0))
+
+        components = graph.connected_components()
+        self.assertEqual(sorted(len(component) for component in components), [2, 4])
+
+        largest = graph.largest_connected_component()
+        self.assertEqual(len(largest), 4)
+        self.assertEqual(len(largest.shortest_path(shapely.Point(0, 0), shapely.Point(3, 0))), 3)
+        self.assertIsNone(largest.shortest_path(shapely.Point(3, 0), shapely.Point(0, 0)))
+
+    def test_shortest_path_matches_dijkstra(self):
+        rng = numpy.random.default_rng(1)
+        graph = map_lines.Graph()
+        points = [shapely.Point(i % 10, i // 10) for i in range(100)]
+        for _ in range(400):
+            a, b = rng.choice(len(points), 2, replace=False)
+            length = float(rng.uniform(1, 10))
+            # Mostly one way streets
+            graph.add_edge(
+                points[a], points[b], length, edge(length), backward_direction=bool(rng.random() < 0.2)
+            )
+
+        distances = scipy.sparse.csgraph.dijkstra(graph.csr(), directed=True)
+        for _ in range(100):
+            a, b = rng.choice(len(points), 2, replace=False)
+            start, end = graph.node_id(points[a]), graph.node_id(points[b])
+            path = graph.shortest_path(points[a], points[b])
+
+            if numpy.isinf(distances[start, end]):
+                self.assertIsNone(path)
+            else:
+                self.assertEqual(path[0].source_point, points[a])
+                self.assertEqual(path[-1].target_point, points[b])
+                self.assertAlmostEqual(sum(p.data.data["length"] for p in path), distances[start, end])